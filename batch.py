@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Answer a list of questions for every document of a corpus.
+
+Documents are ingested on the process pool first, then every
+(document, question) pair is sent as its own request, concurrently and
+under the per-model rate limits of rate_limit_config. Results are
+appended to a JSONL checkpoint as they arrive; running the same command
+again skips the pairs that already have an answer.
+
+Usage:
+    python batch.py corpus/ questions.txt --output results.jsonl --model gpt-4o
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from chat import chat_response_async, prepare_request
+from config import batch_config, chat_models, model_config, prio_model_name
+from llm import AZURE_OPENAI, get_client
+from pdfparser import get_executor, process_file
+from ratelimit import BATCH, request_priority
+from request import build_openai_messages
+
+DOCUMENT_TYPES = (".pdf", ".txt")
+
+# one request: the document, and the question to ask about it
+Job = Dict[str, str]
+
+
+def find_documents(corpus: str) -> List[str]:
+    """Return the PDF and TXT files below a directory, sorted"""
+    paths = []
+    for root, _, names in os.walk(corpus):
+        paths += [
+            os.path.join(root, n) for n in names if n.lower().endswith(DOCUMENT_TYPES)
+        ]
+    return sorted(paths)
+
+
+def load_questions(path: str) -> List[Tuple[str, str]]:
+    """
+    Read the questions from a text file, one per line, or a JSON or JSONL
+    file of strings or {"id": ..., "question": ...} objects.
+
+    Args:
+        path: Path of the questions file
+
+    Returns:
+        List of (question id, question)
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+
+    if path.endswith(".json"):
+        items = json.loads(text)
+    elif path.endswith(".jsonl"):
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        items = [line.strip() for line in text.splitlines() if line.strip()]
+
+    questions = []
+    for i, item in enumerate(items, start=1):
+        if isinstance(item, str):
+            questions.append((f"q{i}", item))
+        else:
+            questions.append((str(item.get("id", f"q{i}")), item["question"]))
+    return questions
+
+
+def load_checkpoint(path: str) -> Set[Tuple[str, str]]:
+    """Return the (file, question id) pairs answered without error in a checkpoint"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut off by an interrupted run
+                continue
+            if not record.get("error"):
+                done.add((record["file"], record["question_id"]))
+    return done
+
+
+def ingest(paths: List[str], max_workers: int) -> Dict[str, str]:
+    """
+    Parse the documents into the parse cache, pages on the process pool.
+
+    Args:
+        paths: Paths of the documents
+        max_workers: Documents parsed at the same time
+
+    Returns:
+        Error message per document that failed
+    """
+    executor = get_executor()
+
+    def parse(path: str) -> Optional[str]:
+        try:
+            process_file(path, executor=executor)
+        except Exception as e:
+            return str(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as threads:
+        errors = dict(zip(paths, threads.map(parse, paths)))
+    return {path: error for path, error in errors.items() if error}
+
+
+def make_record(job: Job, model: str, **fields: Any) -> Dict[str, Any]:
+    return {
+        "file": job["file"],
+        "question_id": job["question_id"],
+        "question": job["question"],
+        "model": model,
+        "answer": None,
+        "token_usage": {},
+        "seconds": 0.0,
+        "error": None,
+        **fields,
+    }
+
+
+async def run_online(
+    jobs: List[Job], model: str, retrieval: bool, output: str, max_concurrency: int
+) -> List[Dict[str, Any]]:
+    """
+    Send every job as a chat request, appending each result to the checkpoint.
+
+    The requests queue behind interactive chat requests in the shared
+    rate limiter.
+
+    Args:
+        jobs: Jobs to run
+        model: Name of the model in model_config
+        retrieval: Send only the chunks relevant to the question instead of the files
+        output: Path of the JSONL checkpoint
+        max_concurrency: Requests in flight at the same time
+
+    Returns:
+        The records written
+    """
+    # the tasks inherit the priority from this context
+    request_priority.set(BATCH)
+    limit = asyncio.Semaphore(max_concurrency)
+    records = []
+
+    with open(output, "a", encoding="utf-8") as f:
+
+        async def run(job: Job):
+            async with limit:
+                start = time.perf_counter()
+                try:
+                    response = await chat_response_async(
+                        job["question"], [], [job["path"]], model, retrieval
+                    )
+                    record = make_record(
+                        job,
+                        response.model or model,
+                        answer=response.content,
+                        token_usage=response.token_usage,
+                    )
+                except Exception as e:
+                    record = make_record(job, model, error=str(e))
+                record["seconds"] = time.perf_counter() - start
+
+            # the loop runs one callback at a time, so lines never interleave
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            records.append(record)
+            print(
+                f"[{len(records)}/{len(jobs)}] {job['file']} {job['question_id']}"
+                + (f" failed: {record['error']}" if record["error"] else "")
+            )
+
+        await asyncio.gather(*(run(job) for job in jobs))
+    return records
+
+
+def run_provider_batch(
+    jobs: List[Job], model: str, retrieval: bool, output: str, poll_interval: float
+) -> List[Dict[str, Any]]:
+    """
+    Run the jobs through the Azure OpenAI batch endpoint.
+
+    The batch id is kept in a state file next to the checkpoint, so an
+    interrupted run resumes polling the same batch instead of submitting
+    the jobs again.
+
+    Args:
+        jobs: Jobs to run
+        model: Name of an Azure OpenAI model in model_config
+        retrieval: Send only the chunks relevant to the question instead of the files
+        output: Path of the JSONL checkpoint
+        poll_interval: Seconds between status checks
+
+    Returns:
+        The records written
+    """
+    client = get_client(model).client
+    state_path = f"{output}.batch.json"
+
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        print(f"Resuming batch {state['batch_id']}")
+    else:
+        input_path = f"{output}.batch_input.jsonl"
+        with open(input_path, "w", encoding="utf-8") as f:
+            for i, job in enumerate(jobs):
+                context, history, _ = prepare_request(
+                    job["question"], [], [job["path"]], model, retrieval
+                )
+                body = {
+                    "model": model_config[model]["model"],
+                    "messages": build_openai_messages(job["question"], history, model, context),
+                }
+                request = {
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/chat/completions",
+                    "body": body,
+                }
+                f.write(json.dumps(request) + "\n")
+
+        with open(input_path, "rb") as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id, endpoint="/chat/completions", completion_window="24h"
+        )
+        state = {"batch_id": batch.id, "jobs": jobs}
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        print(f"Submitted batch {batch.id} with {len(jobs)} requests")
+
+    while True:
+        batch = client.batches.retrieve(state["batch_id"])
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        print(f"Batch {batch.id}: {batch.status}")
+        time.sleep(poll_interval)
+
+    jobs = state["jobs"]
+    records = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            job = jobs[int(result["custom_id"])]
+            body = (result.get("response") or {}).get("body") or {}
+            if result.get("error") or "choices" not in body:
+                error = result.get("error") or body.get("error") or "no response"
+                records[result["custom_id"]] = make_record(job, model, error=str(error))
+                continue
+            usage = body.get("usage") or {}
+            records[result["custom_id"]] = make_record(
+                job,
+                model,
+                answer=body["choices"][0]["message"]["content"].strip(),
+                token_usage={
+                    "prompt_tokens": usage.get("prompt_tokens", 0),
+                    "completion_tokens": usage.get("completion_tokens", 0),
+                    "total_tokens": usage.get("total_tokens", 0),
+                },
+            )
+
+    # requests the batch never got to, e.g. when it expired
+    for i, job in enumerate(jobs):
+        records.setdefault(str(i), make_record(job, model, error=f"batch {batch.status}"))
+
+    with open(output, "a", encoding="utf-8") as f:
+        for record in records.values():
+            f.write(json.dumps(record) + "\n")
+    os.remove(state_path)
+    return list(records.values())
+
+
+def summarize(records: List[Dict[str, Any]], seconds: float) -> Dict[str, Any]:
+    """Return the throughput and token totals of a run"""
+    tokens = Counter()
+    for record in records:
+        tokens.update(record["token_usage"])
+    answered = [r for r in records if not r["error"]]
+    return {
+        "requests": len(records),
+        "answered": len(answered),
+        "failed": len(records) - len(answered),
+        "seconds": seconds,
+        "requests_per_minute": 60 * len(records) / seconds if seconds else None,
+        "tokens": dict(tokens),
+        "tokens_per_second": tokens["total_tokens"] / seconds if seconds else None,
+        "models": dict(Counter(r["model"] for r in answered)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("corpus", help="directory of PDF and TXT documents")
+    parser.add_argument("questions", help="questions file: .txt, .json or .jsonl")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL checkpoint")
+    parser.add_argument("--model", default=prio_model_name, choices=chat_models)
+    parser.add_argument(
+        "--retrieval", action="store_true", help="send only the relevant chunks"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=batch_config["max_concurrency"]
+    )
+    parser.add_argument(
+        "--provider-batch",
+        action="store_true",
+        help="use the Azure OpenAI batch endpoint, cheaper but asynchronous",
+    )
+    parser.add_argument("--poll-interval", type=float, default=60.0)
+    parser.add_argument("--summary", help="write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    paths = find_documents(args.corpus)
+    done = load_checkpoint(args.output)
+
+    jobs = [
+        {
+            "file": os.path.relpath(path, args.corpus),
+            "path": path,
+            "question_id": question_id,
+            "question": question,
+        }
+        for path in paths
+        for question_id, question in questions
+        if (os.path.relpath(path, args.corpus), question_id) not in done
+    ]
+    print(
+        f"{len(paths)} documents, {len(questions)} questions, "
+        f"{len(done)} answered before, {len(jobs)} to run"
+    )
+    if not jobs:
+        return
+
+    start = time.perf_counter()
+    errors = ingest(sorted({job["path"] for job in jobs}), batch_config["ingest_workers"])
+    for path, error in errors.items():
+        print(f"Skipping {path}: {error}")
+    print(f"Ingested in {time.perf_counter() - start:.1f}s")
+    jobs = [job for job in jobs if job["path"] not in errors]
+
+    if args.provider_batch:
+        if model_config[args.model]["client"] != AZURE_OPENAI:
+            parser.error("--provider-batch needs an Azure OpenAI model")
+        records = run_provider_batch(
+            jobs, args.model, args.retrieval, args.output, args.poll_interval
+        )
+    else:
+        records = asyncio.run(
+            run_online(jobs, args.model, args.retrieval, args.output, args.concurrency)
+        )
+
+    summary = summarize(records, time.perf_counter() - start)
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Benchmark the chat path against local fake LLM endpoints.
+
+Generates a PDF and TXT corpus, starts the fake endpoints of
+fakeserver.py and points every model of model_config at them, then
+measures ingestion throughput, create_context time and memory, time to
+first token, and concurrent sessions through chat_wrapper_async. Runs
+in a scratch directory, so the caches and Chroma database of the
+application are left alone.
+
+Usage:
+    python benchmark.py --output report.json --baseline previous.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from fakeserver import FakeSettings, start_fake_server
+
+REPORT_VERSION = 1
+
+ISSUERS = ["Acme Capital", "Northwind Finance", "Contoso Bank", "Fabrikam Holdings"]
+
+
+def sentence(rng: random.Random) -> str:
+    isin = "XS" + "".join(rng.choice("0123456789") for _ in range(10))
+    return rng.choice(
+        [
+            f"The notes of {rng.choice(ISSUERS)} with ISIN {isin} pay a coupon of "
+            f"{rng.randint(1, 9)}.{rng.randint(0, 99):02d}% per annum.",
+            f"Interest is payable on {rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/"
+            f"{rng.randint(2025, 2040)} and on each anniversary thereafter.",
+            f"The issue price is {rng.randint(95, 105)}.{rng.randint(0, 999):03d} percent "
+            "of the aggregate nominal amount.",
+            "The issuer may redeem the notes in whole but not in part at par "
+            "together with accrued interest.",
+            f"The aggregate nominal amount is EUR {rng.randint(100, 900)},000,000.",
+        ]
+    )
+
+
+def generate_lines(rng: random.Random, n_bytes: int, width: int = 90) -> List[str]:
+    lines, line, size = [], "", 0
+    while size < n_bytes:
+        for word in sentence(rng).split():
+            if len(line) + len(word) + 1 > width:
+                lines.append(line)
+                size += len(line) + 1
+                line = ""
+            line = f"{line} {word}" if line else word
+        if rng.random() < 0.1:
+            # paragraph break
+            lines += [line, ""]
+            size += len(line) + 2
+            line = ""
+    return lines + ([line] if line else [])
+
+
+def write_pdf(path: str, pages: List[List[str]]) -> None:
+    """
+    Write a minimal PDF with one text line per entry, Helvetica 10pt.
+
+    Written by hand so the benchmark needs no PDF library to create its
+    corpus.
+
+    Args:
+        path: Path of the PDF
+        pages: Lines of every page
+    """
+
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # the page tree, filled in once the page ids are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        text = "".join(f"({escape(line)}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 800 Td {text}ET".encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for i, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (i, body))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref)
+        )
+
+
+def generate_corpus(
+    directory: str, txt_kb: List[int], pdf_pages: List[int], seed: int = 0
+) -> List[str]:
+    """
+    Write TXT files of the given sizes and PDFs of the given page counts.
+
+    Args:
+        directory: Directory to write to
+        txt_kb: Size of each TXT file, in kilobytes
+        pdf_pages: Number of pages of each PDF
+        seed: Seed of the generated text, so corpora are comparable across runs
+
+    Returns:
+        Paths of the files
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for kb in txt_kb:
+        path = os.path.join(directory, f"notes_{kb}kb.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(generate_lines(rng, kb * 1024)))
+        paths.append(path)
+    for n in pdf_pages:
+        path = os.path.join(directory, f"prospectus_{n}p.pdf")
+        lines = generate_lines(rng, n * 60 * 80)
+        write_pdf(path, [lines[i : i + 60] for i in range(0, 60 * n, 60)])
+        paths.append(path)
+    return paths
+
+
+def configure_environment(base_url: str) -> None:
+    """Point every model of model_config at the fake endpoints, before config is imported"""
+    for prefix in ["GPT4O", "O1"]:
+        os.environ[f"{prefix}_ENDPOINT"] = base_url
+        os.environ[f"{prefix}_KEY"] = "fake"
+        os.environ[f"{prefix}_VERSION"] = "2024-06-01"
+    os.environ["GPT4O_MODEL"] = "gpt-4o"
+    os.environ["O1_MODEL"] = "o1-preview"
+    os.environ["EMBEDDING_ENDPOINT"] = base_url
+    os.environ["EMBEDDING_KEY"] = "fake"
+    os.environ["EMBEDDING_VERSION"] = "2024-06-01"
+    os.environ["EMBEDDING_MODEL"] = "text-embedding-3-large"
+    os.environ["GEMINI_API_KEY"] = "fake"
+    os.environ["GEMINI_MODEL"] = "gemini-fake"
+    os.environ["GEMINI_BASE_URL"] = base_url
+    # the quotas of real deployments don't apply to the fake endpoints
+    for prefix in ["GEMINI", "GPT4O", "O1", "EMBEDDING"]:
+        os.environ[f"{prefix}_RPM"] = "0"
+        os.environ[f"{prefix}_TPM"] = "0"
+    os.environ["WARMUP"] = "0"
+
+
+def fresh_parse_cache(name: str) -> None:
+    """Swap in an empty parse cache, so the next measurement starts cold"""
+    import pdfparser
+    from config import cache_config
+    from filecache import FileCache
+
+    pdfparser.parse_cache = FileCache(
+        os.path.join(cache_config["path"], f"parse_cache_{name}.sqlite"),
+        max_bytes=cache_config["parse_cache_max_bytes"],
+    )
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "mean": statistics.mean(samples)}
+
+
+def bench_ingestion(files: List[str]) -> Dict[str, Any]:
+    """Parse all files on the process pool, cold and then from the parse cache"""
+    from pdfparser import process_files
+
+    fresh_parse_cache("ingestion")
+    n_bytes = sum(os.path.getsize(f) for f in files)
+
+    start = time.perf_counter()
+    documents = process_files(files)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    process_files(files)
+    warm = time.perf_counter() - start
+
+    return {
+        "files": len(files),
+        "bytes": n_bytes,
+        "chunks": sum(len(d) for d in documents),
+        "cold_seconds": cold,
+        "cold_mb_per_second": n_bytes / 1024**2 / cold,
+        "warm_seconds": warm,
+    }
+
+
+def bench_create_context(files: List[str], model: str) -> Dict[str, Any]:
+    """Time create_context per file, cold and cached, and its peak Python memory"""
+    from config import completion_token_reserve, context_windows, history_token_share
+    from pdfparser import create_context
+
+    window = context_windows[model] - completion_token_reserve
+    budget = window - int(window * history_token_share)
+
+    results = {}
+    for path in files:
+        fresh_parse_cache(f"context_{os.path.basename(path)}")
+        start = time.perf_counter()
+        create_context([path], budget, model)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        create_context([path], budget, model)
+        warm = time.perf_counter() - start
+
+        fresh_parse_cache(f"memory_{os.path.basename(path)}")
+        tracemalloc.start()
+        create_context([path], budget, model)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[os.path.basename(path)] = {
+            "bytes": os.path.getsize(path),
+            "cold_seconds": cold,
+            "warm_seconds": warm,
+            "peak_python_mb": peak / 1024**2,
+        }
+    return results
+
+
+def bench_ttft(model: str, requests: int) -> Dict[str, Any]:
+    """Send sequential streamed requests without files and time their first token"""
+    from chat import chat_response_stream
+
+    ttft, totals, tokens = [], [], 0
+    for i in range(requests):
+        start = time.perf_counter()
+        first = None
+        for response in chat_response_stream(f"Benchmark question {i}?", [], [], model):
+            if first is None and response.content:
+                first = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        ttft.append(first if first is not None else totals[-1])
+        tokens += response.token_usage.get("completion_tokens", 0)
+
+    return {
+        "requests": requests,
+        "ttft_seconds": percentiles(ttft),
+        "total_seconds": percentiles(totals),
+        "completion_tokens_per_second": tokens / sum(totals),
+    }
+
+
+async def _session(
+    chat_wrapper, model: str, files: List[str], turns: int, session: int
+) -> Dict[str, List[float]]:
+    history: List[dict] = []
+    ttft, totals = [], []
+    for turn in range(turns):
+        start = time.perf_counter()
+        first = None
+        async for _, chat_history, content, _, _ in chat_wrapper(
+            f"Session {session}, question {turn}: what is the coupon?", history, files, model
+        ):
+            if first is None and content:
+                first = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        ttft.append(first if first is not None else totals[-1])
+        # gradio hands the chatbot back as plain messages on the next turn
+        history = [
+            {"role": m.role, "content": m.content} if hasattr(m, "role") else m
+            for m in chat_history
+        ]
+    return {"ttft": ttft, "totals": totals}
+
+
+def bench_concurrency(
+    model: str, sessions: int, turns: int, files: List[str]
+) -> Dict[str, Any]:
+    """Run concurrent multi-turn sessions through chat_wrapper_async"""
+    from chat import chat_wrapper_async
+
+    async def run():
+        return await asyncio.gather(
+            *(_session(chat_wrapper_async, model, files, turns, i) for i in range(sessions))
+        )
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    wall = time.perf_counter() - start
+
+    ttft = [t for r in results for t in r["ttft"]]
+    totals = [t for r in results for t in r["totals"]]
+    return {
+        "sessions": sessions,
+        "turns": turns,
+        "files": [os.path.basename(f) for f in files],
+        "wall_seconds": wall,
+        "turns_per_second": len(totals) / wall,
+        "ttft_seconds": percentiles(ttft),
+        "turn_seconds": percentiles(totals),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def flatten(report: Any, prefix: str = "") -> Dict[str, float]:
+    if isinstance(report, dict):
+        flat = {}
+        for key, value in report.items():
+            flat.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+        return flat
+    if isinstance(report, (int, float)) and not isinstance(report, bool):
+        return {prefix: report}
+    return {}
+
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]) -> None:
+    """Print the relative change of every number of the results against a baseline"""
+    old, new = flatten(baseline["results"]), flatten(report["results"])
+    for key in sorted(old.keys() & new.keys()):
+        if old[key]:
+            change = (new[key] - old[key]) / abs(old[key])
+            print(f"{key:70s} {old[key]:12.4g} -> {new[key]:12.4g} ({change:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--baseline", help="earlier report to compare with")
+    parser.add_argument("--workdir", help="scratch directory, a temporary one by default")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--txt-kb", type=int, nargs="*", default=[16, 256, 4096])
+    parser.add_argument("--pdf-pages", type=int, nargs="*", default=[5, 50, 200])
+    parser.add_argument("--requests", type=int, default=20, help="sequential TTFT requests")
+    parser.add_argument("--sessions", type=int, default=16, help="concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="turns per session")
+    parser.add_argument("--latency", type=float, default=FakeSettings.latency)
+    parser.add_argument("--tokens-per-second", type=float, default=FakeSettings.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=FakeSettings.answer_tokens)
+    parser.add_argument("--error-rate", type=float, default=FakeSettings.error_rate)
+    parser.add_argument("--error-status", type=int, default=FakeSettings.error_status)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    settings = FakeSettings(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    server = start_fake_server(settings)
+    configure_environment(f"http://127.0.0.1:{server.server_address[1]}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chat_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    files = generate_corpus(os.path.join(workdir, "corpus"), args.txt_kb, args.pdf_pages)
+
+    # measure the request path itself, not the response cache
+    from config import cache_config
+
+    cache_config["response_cache"] = False
+
+    results = {}
+    print("Ingestion...")
+    results["ingestion"] = bench_ingestion(files)
+    print("create_context...")
+    results["create_context"] = bench_create_context(files, args.model)
+    print("Time to first token...")
+    results["ttft"] = bench_ttft(args.model, args.requests)
+    print("Concurrent sessions...")
+    results["concurrency"] = bench_concurrency(
+        args.model, args.sessions, args.turns, files[:1]
+    )
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    report = {
+        "version": REPORT_VERSION,
+        "timestamp": time.time(),
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            **vars(settings),
+            "model": args.model,
+            "txt_kb": args.txt_kb,
+            "pdf_pages": args.pdf_pages,
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), report)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
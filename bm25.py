@@ -0,0 +1,184 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# dates, numbers with decimals or percent signs are kept whole so that
+# identifiers like "30/05/2031", "108.714" or "8.00%" match exactly
+_token_pattern = re.compile(
+    r"\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}|\d+(?:[.,]\d+)*%?|[^\W_]+",
+    re.UNICODE,
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token.lower() for token in _token_pattern.findall(text)]
+
+
+class BM25Index:
+    """
+    Sparse BM25 index of chunks, persisted in a SQLite file.
+
+    Chunks are added incrementally by id; chunks already in the index are
+    skipped. Every chunk is stored with the content digest of its file, the
+    key searches are restricted by. Scores use the usual Okapi BM25
+    weighting.
+
+    Attributes:
+        path: Path of the SQLite file
+        k1: Term frequency saturation
+        b: Length normalization
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as con:
+            columns = [row[1] for row in con.execute("PRAGMA table_info(docs)")]
+            if columns and "digest" not in columns:
+                # chunks indexed by file name only can't be scoped to an upload
+                con.executescript("DROP TABLE docs; DROP TABLE IF EXISTS postings;")
+            con.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS docs (
+                    id TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    length INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS docs_digest ON docs (digest);
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    tf INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+                """
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def add(self, documents: Sequence, digest: str) -> int:
+        """
+        Index the chunks that are not in the index yet.
+
+        Args:
+            documents: Document objects to index
+            digest: Content digest of the file the documents come from
+
+        Returns:
+            Number of chunks added
+        """
+        con = self._connection()
+        ids = [d.id for d in documents]
+        existing = set()
+        for i in range(0, len(ids), 500):
+            batch = ids[i : i + 500]
+            existing.update(
+                id
+                for (id,) in con.execute(
+                    f"SELECT id FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch
+                )
+            )
+
+        new = {d.id: d for d in documents if d.id not in existing}
+        if not new:
+            return 0
+
+        added = 0
+        with con:
+            # another thread or process may be indexing the same file; the write
+            # lock is taken up front and rows it added in the meantime are skipped,
+            # so their postings aren't written twice
+            con.execute("BEGIN IMMEDIATE")
+            for document in new.values():
+                tokens = tokenize(document.text)
+                inserted = con.execute(
+                    "INSERT OR IGNORE INTO docs (id, digest, length) VALUES (?, ?, ?)",
+                    (document.id, digest, len(tokens)),
+                ).rowcount
+                if not inserted:
+                    continue
+                con.executemany(
+                    "INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                    [(term, document.id, tf) for term, tf in Counter(tokens).items()],
+                )
+                added += 1
+        return added
+
+    def search(
+        self, query: str, n_results: int, digests: Optional[List[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Return the best matching chunks for a query.
+
+        Args:
+            query: Text to search for
+            n_results: Number of chunks to return
+            digests: Only search chunks of the files with these content digests
+
+        Returns:
+            List of (id, score), best first
+        """
+        con = self._connection()
+        n_docs, total_length = con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs"
+        ).fetchone()
+        if not n_docs:
+            return []
+        avg_length = total_length / n_docs
+
+        where = ""
+        if digests is not None:
+            where = f"AND d.digest IN ({','.join('?' * len(digests))})"
+
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            (df,) = con.execute(
+                "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)
+            ).fetchone()
+            if not df:
+                continue
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+            for id, tf, length in con.execute(
+                f"""
+                SELECT p.id, p.tf, d.length FROM postings p JOIN docs d ON p.id = d.id
+                WHERE p.term = ? {where}
+                """,
+                [term] + list(digests or []),
+            ):
+                norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """
+    Merge rankings by summing 1 / (k + rank) of every id over the rankings.
+
+    Args:
+        rankings: Lists of ids, best first
+        k: Damping constant, larger values flatten the rank differences
+
+    Returns:
+        Ids ordered by fused score, best first
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
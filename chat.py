@@ -1,10 +1,270 @@
-from typing import List, Tuple, Any, Dict, BinaryIO, Optional
+from typing import List, Tuple, Any, AsyncIterator, Dict, Iterator, Optional
+import asyncio
+import threading
+import time
+from concurrent.futures import as_completed
+from functools import partial
 import gradio as gr
 import os
-from pdfparser import Document, create_context
-from ui import llm_client
-from request import handle_openai_request, handle_gemini_request, Response
-from config import prio_model_name
+from pdfparser import (
+    build_context,
+    file_digest,
+    get_executor,
+    process_file,
+    stream_threshold,
+)
+from embedding import (
+    create_retrieval_context,
+    embed_documents_to_chroma,
+    get_bm25_index,
+    get_collection,
+    get_embedding_function,
+)
+from ingestion import Ingestor
+from llm import get_async_client, get_client
+from dispatch import (
+    Prepare,
+    dispatch,
+    dispatch_async,
+    dispatch_stream,
+    dispatch_stream_async,
+    memoize_prepare,
+)
+from filecache import FileCache
+from responsecache import ResponseCache, request_key
+from singleflight import AsyncSingleFlight, SingleFlight
+from request import (
+    handle_openai_request,
+    handle_gemini_request,
+    handle_openai_request_async,
+    handle_gemini_request_async,
+    stream_openai_request,
+    stream_gemini_request,
+    stream_openai_request_async,
+    stream_gemini_request_async,
+    Response,
+)
+from config import (
+    cache_config,
+    chat_models,
+    completion_token_reserve,
+    context_windows,
+    history_config,
+    history_token_share,
+    ingestion_config,
+    prio_model_name,
+    vector_db_config,
+    warmup_config,
+)
+from history import HistoryManager
+from telemetry import Span, tracer
+from tokens import count_message_tokens, count_tokens, get_encoding, model_encodings
+
+
+response_cache = None
+if cache_config["response_cache"]:
+    response_cache = ResponseCache(
+        FileCache(
+            os.path.join(cache_config["path"], "response_cache.sqlite"),
+            max_bytes=cache_config["response_cache_max_bytes"],
+            ttl=cache_config["response_cache_ttl"],
+        ),
+        # the embedding model is loaded by the first lookup, not at import
+        embedding_function=(
+            (lambda texts: get_embedding_function()(texts))
+            if cache_config["semantic_cache"]
+            else None
+        ),
+        similarity_threshold=cache_config["semantic_cache_threshold"],
+    )
+
+
+def summarize_history(summary: Optional[str], messages: List[dict], model: str) -> str:
+    """
+    Extend a summary of the conversation with more messages.
+
+    Args:
+        summary: Summary of the earlier messages, if any
+        messages: Messages to add to the summary
+        model: Model that writes the summary
+
+    Returns:
+        The new summary
+    """
+    transcript = "\n\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+    message = (
+        f"Summarize the conversation below in at most {history_config['summary_max_tokens'] // 2}"
+        " words. Keep facts, figures, names and open questions, drop pleasantries.\n\n"
+    )
+    if summary:
+        message += f"Summary so far:\n{summary}\n\nNew messages:\n"
+    message += transcript
+
+    request_dispatcher = {
+        "gpt-4o": handle_openai_request,
+        "o1-preview": handle_openai_request,
+        "gemini": handle_gemini_request,
+    }
+    return request_dispatcher[model](get_client(model), message, [], model).content
+
+
+history_manager = HistoryManager(
+    summarize_history if history_config["summary"] else None,
+    summary_max_tokens=history_config["summary_max_tokens"],
+    fold_batch=history_config["fold_batch"],
+)
+
+
+def file_context_budget(model: str) -> int:
+    """Return the tokens of the model's window given to the files"""
+    window = context_windows[model] - completion_token_reserve
+    return window - int(window * history_token_share)
+
+
+def ingest_file(file_path: str, embed: bool, cancelled: threading.Event) -> None:
+    """
+    Parse an uploaded file into the parse cache, and embed it into Chroma.
+
+    Args:
+        file_path: Path of the uploaded file
+        embed: Whether to embed the chunks as well
+        cancelled: Set when the file was removed before ingestion finished
+    """
+    # files larger than any context budget are streamed into the context
+    # page by page instead
+    largest_budget = max(file_context_budget(m) for m in chat_models)
+    if not embed and os.path.getsize(file_path) > stream_threshold(largest_budget):
+        return
+    documents = process_file(file_path, executor=get_executor())
+    if embed and not cancelled.is_set():
+        embed_documents_to_chroma(documents, file_digest(file_path))
+
+
+# uploads are ingested before the first message; requests reuse the results
+ingestor = Ingestor(ingest_file, max_workers=ingestion_config["background_workers"])
+
+
+def ingest_wrapper(files: Optional[List[str]], previous: List[str], retrieval: bool = False):
+    """
+    Ingest the files of a session in the background, reporting progress.
+
+    Args:
+        files: Files currently uploaded in the session
+        previous: Files uploaded in the session before the change
+        retrieval: Whether retrieval mode is on, so the files are embedded as well
+
+    Yields:
+        Tuple of the progress text and the files of the session
+    """
+    files = files or []
+    futures = ingestor.update(previous, files, embed=retrieval)
+    if not futures:
+        yield "", files
+        return
+
+    done = failed = 0
+    yield f"**Files:** 0/{len(futures)} ready", files
+    for future in as_completed(futures):
+        done += 1
+        if not future.cancelled() and future.exception() is not None:
+            failed += 1
+        status = f"**Files:** {done}/{len(futures)} ready"
+        if failed:
+            status += f" ({failed} failed)"
+        yield status, files
+
+
+def prepare_request(
+    message: str,
+    history: List[dict],
+    files: List[str],
+    model: str,
+    retrieval: bool = False,
+) -> Tuple[Optional[str], List[dict], Dict[str, Any]]:
+    """
+    Split the model's context window between the message, the history and the files.
+
+    The files get a fixed share of the window that doesn't depend on the
+    conversation, so the context stays byte-identical across turns and the
+    providers can cache the prompt prefix. The message and the history
+    share the remaining history_token_share of the window; older messages
+    that don't fit are folded into a rolling summary.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        files: List of uploaded PDF files
+        model: Name of the model in model_config
+        retrieval: Send only the chunks relevant to the message instead of the full files
+
+    Returns:
+        Tuple of the context, the history to send and the budget report
+    """
+    # files uploaded just before the message may still be ingesting
+    ingestor.wait(files)
+
+    window = context_windows[model] - completion_token_reserve
+    conversation_budget = int(window * history_token_share)
+    message_tokens = count_tokens(message, model)
+
+    history, history_report = history_manager.compact(
+        history, conversation_budget - message_tokens, model
+    )
+    history_tokens = count_message_tokens(history, model)
+
+    context_budget = file_context_budget(model)
+    if retrieval:
+        context_budget = min(context_budget, vector_db_config["retrieval_token_budget"])
+        context, report = create_retrieval_context(
+            files, message, model, token_budget=context_budget
+        )
+    else:
+        context, report = build_context(files, context_budget, model)
+
+    report.update(
+        {
+            "window": window,
+            "message_tokens": message_tokens,
+            "history_tokens": history_tokens,
+            "history_messages": len(history),
+            **history_report,
+        }
+    )
+    prompt_tokens = report["context_tokens"] + history_tokens + message_tokens
+    report["history_share"] = history_tokens / prompt_tokens if prompt_tokens else 0
+    return context, history, report
+
+
+# identical requests in flight at the same time share one LLM call
+request_flight = SingleFlight()
+async_request_flight = AsyncSingleFlight()
+
+
+def prepared_request_key(prepare: Prepare, message: str, model: str) -> str:
+    context, history, _ = prepare(model)
+    return request_key(model, context, history, message)
+
+
+def lookup_response(prepare: Prepare, message: str, model: str) -> Optional[Response]:
+    """Return the cached response to the message, if the response cache has one"""
+    if response_cache is None:
+        return None
+
+    context, history, budget = prepare(model)
+    with tracer.span("response_cache", model=model) as span:
+        response = response_cache.get(model, context, history, message)
+        span.set(cache=response.cache if response is not None else None)
+    if response is not None:
+        response.budget = budget
+    return response
+
+
+def store_response(prepare: Prepare, message: str, model: str, response: Response) -> None:
+    if response_cache is None or not response.content:
+        return
+
+    context, history, _ = prepare(model)
+    response_cache.put(model, context, history, message, response)
 
 
 def chat_response(
@@ -12,6 +272,7 @@ def chat_response(
     history: List[dict] = [],
     files: List[str] = [],
     model: str = prio_model_name,
+    retrieval: bool = False,
 ) -> Response:
     """
     Generate response using either PDF context or general knowledge via OpenAI or Gemini.
@@ -20,48 +281,296 @@ def chat_response(
         message: The user's message
         history: Conversation history
         files: List of uploaded PDF files
+        retrieval: Send only the chunks relevant to the message instead of the full files
 
     Returns:
         Tuple containing the response text and token usage information
     """
-    context = create_context(files)
-
     request_dispatcher = {
         "gpt-4o": handle_openai_request,
         "o1-preview": handle_openai_request,
         "gemini": handle_gemini_request,
     }
-    return request_dispatcher[llm_client.model](
-        llm_client, message, history, model, context
+    prepare = memoize_prepare(
+        partial(prepare_request, message, history, files, retrieval=retrieval)
+    )
+    response = lookup_response(prepare, message, model)
+    if response is not None:
+        return response
+
+    def send():
+        response = dispatch(request_dispatcher, get_client, prepare, message, model)
+        store_response(prepare, message, model, response)
+        return response
+
+    return request_flight.do(prepared_request_key(prepare, message, model), send)
+
+
+def chat_response_stream(
+    message: str,
+    history: List[dict] = [],
+    files: List[str] = [],
+    model: str = prio_model_name,
+    retrieval: bool = False,
+) -> Iterator[Response]:
+    """
+    Stream a response using either PDF context or general knowledge via OpenAI or Gemini.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        files: List of uploaded PDF files
+        retrieval: Send only the chunks relevant to the message instead of the full files
+
+    Yields:
+        Response with the text received so far; the last one carries the token usage
+    """
+    request_dispatcher = {
+        "gpt-4o": stream_openai_request,
+        "o1-preview": stream_openai_request,
+        "gemini": stream_gemini_request,
+    }
+    prepare = memoize_prepare(
+        partial(prepare_request, message, history, files, retrieval=retrieval)
     )
+    response = lookup_response(prepare, message, model)
+    if response is not None:
+        yield response
+        return
+
+    def send():
+        for response in dispatch_stream(
+            request_dispatcher, get_client, prepare, message, model
+        ):
+            yield response
+        store_response(prepare, message, model, response)
 
+    yield from request_flight.stream(prepared_request_key(prepare, message, model), send)
 
-def chat_wrapper(message: str, history: List[dict], files: List[str], model: str):
-    """Wrapper function to handle chat interactions"""
 
-    response = chat_response(message, history, files, model)
+def format_token_info(response: Response) -> str:
     p_tokens = response.token_usage["prompt_tokens"]
     c_tokens = response.token_usage["completion_tokens"]
     t_tokens = response.token_usage["total_tokens"]
+    budget = response.budget
 
-    # Create token usage information
     token_info = f"**Token Usage:** Prompt: {p_tokens} | Completion: {c_tokens} | Total: {t_tokens}"
-    last_response = response.content
+    if budget:
+        token_info += (
+            f"\n\n**Budget:** Files: {budget['context_tokens']}/{budget['context_budget']}"
+            f" | History: {budget['history_tokens']} ({budget['history_share']:.0%})"
+            f" | Message: {budget['message_tokens']}"
+        )
+        if budget["summarized_messages"]:
+            token_info += f" | Summarized messages: {budget['summarized_messages']}"
+    if response.token_usage.get("cached_tokens"):
+        token_info += f" | Cached prompt: {response.token_usage['cached_tokens']}"
+    if response_cache is not None:
+        hit_ratio = response_cache.stats()["hit_ratio"] or 0
+        token_info += f"\n\n**Cache:** {response.cache or 'miss'} | Hit ratio: {hit_ratio:.0%}"
+    return token_info
 
-    # Add messages to history
+
+def _count_update(span: Span) -> None:
+    span.set(updates=span.attributes["updates"] + 1)
+
+
+def chat_wrapper(
+    message: str,
+    history: List[dict],
+    files: List[str],
+    model: str,
+    retrieval: bool = False,
+):
+    """Wrapper function to handle chat interactions, streaming the answer into the chatbot"""
+
+    # Add messages to history, the answer is filled in while it streams
     history += [
         gr.ChatMessage(role="user", content=message),
-        gr.ChatMessage(
-            role="assistant",
-            content=last_response,
-        ),
+        gr.ChatMessage(role="assistant", content=""),
+    ]
+    token_info = "**Token Usage:** Streaming..."
+
+    # Clear message box
+    msg = ""
+
+    # the span covers the whole answer as the user sees it; the time Gradio
+    # takes to render the updates happens elsewhere and isn't part of it
+    span = tracer.start_span("chat_wrapper", model=model, updates=0)
+    try:
+        for response in chat_response_stream(message, history[:-2], files, model, retrieval):
+            history[-1] = gr.ChatMessage(role="assistant", content=response.content)
+            update = (msg, history, response.content, token_info, f"**Model:** {response.model}")
+            _count_update(span)
+            yield update
+
+        # Token usage is only known once the stream has finished
+        token_info = format_token_info(response)
+
+        # Return new states of objects, the answer may come from a failover model
+        yield msg, history, response.content, token_info, f"**Model:** {response.model}"
+    except BaseException as e:
+        span.end(e)
+        raise
+    span.set(cache=response.cache)
+    span.end()
+
+
+async def chat_response_async(
+    message: str,
+    history: List[dict] = [],
+    files: List[str] = [],
+    model: str = prio_model_name,
+    retrieval: bool = False,
+) -> Response:
+    """
+    Generate a response like chat_response, on the asyncio clients.
+
+    Parsing and context building run in a worker thread so the event loop
+    stays free for other sessions.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        files: List of uploaded PDF files
+        retrieval: Send only the chunks relevant to the message instead of the full files
+
+    Returns:
+        Response containing the response text and token usage information
+    """
+    request_dispatcher = {
+        "gpt-4o": handle_openai_request_async,
+        "o1-preview": handle_openai_request_async,
+        "gemini": handle_gemini_request_async,
+    }
+    prepare = memoize_prepare(
+        partial(prepare_request, message, history, files, retrieval=retrieval)
+    )
+    response = await asyncio.to_thread(lookup_response, prepare, message, model)
+    if response is not None:
+        return response
+
+    async def send():
+        response = await dispatch_async(
+            request_dispatcher, get_async_client, prepare, message, model
+        )
+        await asyncio.to_thread(store_response, prepare, message, model, response)
+        return response
+
+    key = await asyncio.to_thread(prepared_request_key, prepare, message, model)
+    return await async_request_flight.do(key, send)
+
+
+async def chat_response_stream_async(
+    message: str,
+    history: List[dict] = [],
+    files: List[str] = [],
+    model: str = prio_model_name,
+    retrieval: bool = False,
+) -> AsyncIterator[Response]:
+    """
+    Stream a response like chat_response_stream, on the asyncio clients.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        files: List of uploaded PDF files
+        retrieval: Send only the chunks relevant to the message instead of the full files
+
+    Yields:
+        Response with the text received so far; the last one carries the token usage
+    """
+    request_dispatcher = {
+        "gpt-4o": stream_openai_request_async,
+        "o1-preview": stream_openai_request_async,
+        "gemini": stream_gemini_request_async,
+    }
+    prepare = memoize_prepare(
+        partial(prepare_request, message, history, files, retrieval=retrieval)
+    )
+    response = await asyncio.to_thread(lookup_response, prepare, message, model)
+    if response is not None:
+        yield response
+        return
+
+    async def send():
+        async for response in dispatch_stream_async(
+            request_dispatcher, get_async_client, prepare, message, model
+        ):
+            yield response
+        await asyncio.to_thread(store_response, prepare, message, model, response)
+
+    key = await asyncio.to_thread(prepared_request_key, prepare, message, model)
+    async for response in async_request_flight.stream(key, send):
+        yield response
+
+
+async def chat_wrapper_async(
+    message: str,
+    history: List[dict],
+    files: List[str],
+    model: str,
+    retrieval: bool = False,
+):
+    """Async wrapper function to handle chat interactions, streaming the answer into the chatbot"""
+
+    history += [
+        gr.ChatMessage(role="user", content=message),
+        gr.ChatMessage(role="assistant", content=""),
     ]
+    token_info = "**Token Usage:** Streaming..."
 
     # Clear message box
     msg = ""
 
-    # Return new states of objects
-    return msg, history, last_response, token_info, model
+    span = tracer.start_span("chat_wrapper", model=model, updates=0)
+    try:
+        async for response in chat_response_stream_async(
+            message, history[:-2], files, model, retrieval
+        ):
+            history[-1] = gr.ChatMessage(role="assistant", content=response.content)
+            update = (msg, history, response.content, token_info, f"**Model:** {response.model}")
+            _count_update(span)
+            yield update
+
+        token_info = format_token_info(response)
+
+        yield msg, history, response.content, token_info, f"**Model:** {response.model}"
+    except BaseException as e:
+        span.end(e)
+        raise
+    span.set(cache=response.cache)
+    span.end()
+
+
+def warmup() -> Dict[str, float]:
+    """
+    Build what the first request would otherwise build: the clients of
+    the chat models, the tokenizers, the Chroma collection and the PDF
+    process pool. Failures are printed and left to the first request.
+
+    Returns:
+        Seconds taken per step
+    """
+    steps = {
+        "tokenizers": lambda: [get_encoding(m) for m in model_encodings],
+        "clients": lambda: [(get_client(m), get_async_client(m)) for m in chat_models],
+    }
+    if warmup_config["chroma"]:
+        steps["chroma"] = lambda: (get_collection(), get_bm25_index())
+    if warmup_config["process_pool"]:
+        steps["process_pool"] = lambda: get_executor().submit(os.getpid).result()
+
+    timings = {}
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"Warmup of {name} failed: {e}")
+        timings[name] = time.perf_counter() - start
+    print("Warmup done: " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+    return timings
 
 
 def add_to_history(message: str, history: List[dict]):
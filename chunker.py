@@ -0,0 +1,124 @@
+import re
+from bisect import bisect_left, bisect_right
+from typing import List, Tuple
+
+from config import vector_db_config
+from tokens import count_tokens, token_offsets
+
+# chunk sizes are counted with the tokenizer of the embedding model
+CHUNK_MODEL = "text-embedding-3-large"
+
+_paragraph_break = re.compile(r"\n\s*\n")
+_sentence_end = re.compile(r"(?<=[.!?;:])\s+(?=\S)")
+_whitespace = re.compile(r"\s+")
+
+# (start, end, paragraph_start) character span of a sentence
+Unit = Tuple[int, int, bool]
+
+
+def _split_units(text: str, max_tokens: int) -> List[Unit]:
+    """Split text into sentence spans, cutting sentences longer than max_tokens at whitespace"""
+    units = []
+    paragraph_start = 0
+    for paragraph in [*_paragraph_break.finditer(text), None]:
+        paragraph_end = paragraph.start() if paragraph else len(text)
+
+        start = paragraph_start
+        first = True
+        for sentence in [*_sentence_end.finditer(text, paragraph_start, paragraph_end), None]:
+            end = sentence.start() if sentence else paragraph_end
+            if text[start:end].strip():
+                for span in _split_long(text, start, end, max_tokens):
+                    units.append((*span, first))
+                    first = False
+            start = sentence.end() if sentence else end
+
+        paragraph_start = paragraph.end() if paragraph else len(text)
+    return units
+
+
+def _split_long(text: str, start: int, end: int, max_tokens: int) -> List[Tuple[int, int]]:
+    if count_tokens(text[start:end], CHUNK_MODEL) <= max_tokens:
+        return [(start, end)]
+
+    # the sentence is tokenized once and each piece is cut at the last whitespace
+    # before its max_tokens-th token, instead of counting ever longer prefixes
+    offsets = [start + offset for offset in token_offsets(text[start:end], CHUNK_MODEL)]
+    breaks = [(m.start(), m.end()) for m in _whitespace.finditer(text, start, end)]
+    # end of the word before each whitespace
+    word_ends = [word_end for word_end, _ in breaks]
+
+    spans = []
+    piece_start = start
+    while True:
+        first_token = bisect_left(offsets, piece_start)
+        if first_token + max_tokens >= len(offsets):
+            break
+        limit = offsets[first_token + max_tokens]
+        first_break = bisect_right(word_ends, piece_start)
+        last_break = bisect_right(word_ends, limit) - 1
+        if last_break < first_break:
+            # a word longer than max_tokens is kept whole
+            if first_break == len(breaks):
+                break
+            last_break = first_break
+        # a piece tokenized on its own may take a token more than within the sentence
+        while (
+            last_break > first_break
+            and count_tokens(text[piece_start : word_ends[last_break]], CHUNK_MODEL) > max_tokens
+        ):
+            last_break -= 1
+        spans.append((piece_start, word_ends[last_break]))
+        piece_start = breaks[last_break][1]
+    spans.append((piece_start, end))
+    return spans
+
+
+def chunk_spans(
+    text: str,
+    max_tokens: int = vector_db_config["chunk_tokens"],
+    overlap_tokens: int = vector_db_config["chunk_overlap_tokens"],
+) -> List[Tuple[int, int]]:
+    """
+    Split text into chunks of at most max_tokens on sentence boundaries.
+
+    Sentences are packed greedily; a chunk that is at least half full is
+    closed at a paragraph break rather than carrying on into the next
+    paragraph. Each chunk repeats the last sentences of the previous one,
+    up to overlap_tokens.
+
+    Args:
+        text: Text to split
+        max_tokens: Maximum number of tokens per chunk
+        overlap_tokens: Maximum number of tokens repeated from the previous chunk
+
+    Returns:
+        List of (start, end) character offsets of the chunks
+    """
+    units = _split_units(text, max_tokens)
+    tokens = [count_tokens(text[start:end], CHUNK_MODEL) for start, end, _ in units]
+
+    chunks = []
+    first = 0
+    while first < len(units):
+        last = first
+        total = tokens[first]
+        while last + 1 < len(units) and total + tokens[last + 1] <= max_tokens:
+            if units[last + 1][2] and total >= max_tokens // 2:
+                break
+            last += 1
+            total += tokens[last]
+        chunks.append((units[first][0], units[last][1]))
+
+        if last + 1 == len(units):
+            break
+
+        # step back over the sentences that are repeated in the next chunk
+        next_first = last + 1
+        overlap = 0
+        while next_first - 1 > first and overlap + tokens[next_first - 1] <= overlap_tokens:
+            next_first -= 1
+            overlap += tokens[next_first]
+        first = next_first
+
+    return chunks
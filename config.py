@@ -1,50 +1,224 @@
 #!/usr/bin/env python3
-from openai import AzureOpenAI
-from google import genai
-
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 model_config = {
-    # sorted by priority
+    # sorted by priority; clients are given by import path and imported on first use
     "gemini": {
         "api_key": os.getenv("GEMINI_API_KEY"),
         "model": os.getenv("GEMINI_MODEL"),
-        "client": genai.Client,
+        # e.g. the local fake endpoints of the benchmarks
+        "base_url": os.getenv("GEMINI_BASE_URL"),
+        "client": "google.genai.Client",
     },
     "gpt-4o": {
         "azure_endpoint": os.getenv("GPT4O_ENDPOINT"),
         "api_key": os.getenv("GPT4O_KEY"),
         "api_version": os.getenv("GPT4O_VERSION"),
         "model": os.getenv("GPT4O_MODEL"),
-        "client": AzureOpenAI,
+        "client": "openai.AzureOpenAI",
     },
     "o1-preview": {
         "azure_endpoint": os.getenv("O1_ENDPOINT"),
         "api_key": os.getenv("O1_KEY"),
         "api_version": os.getenv("O1_VERSION"),
         "model": os.getenv("O1_MODEL"),
-        "client": AzureOpenAI,
+        "client": "openai.AzureOpenAI",
+        "stream": False,
+        "system_role": False,
     },
     "text-embedding-3-large": {
         "azure_endpoint": os.getenv("EMBEDDING_ENDPOINT"),
         "api_key": os.getenv("EMBEDDING_KEY"),
         "api_model": os.getenv("EMBEDDING_MODEL"),
         "api_version": os.getenv("EMBEDDING_VERSION"),
-        "client": AzureOpenAI,
+        "client": "openai.AzureOpenAI",
     },
 }
 available_models = [k for k in model_config.keys() if model_config[k]["api_key"]]
 
 prio_model_name = available_models[0]
 
+http_config = {
+    # connection pool of the async clients, one pool per model
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 60,
+    # number of chat requests the UI serves at the same time
+    "concurrency_limit": 64,
+}
+
 vector_db_config = {
-    "n_results": 2,
-    "chunk_size": 1000,
+    # chunks retrieved per message, enough to fill retrieval_token_budget;
+    # the budget cuts the list short when chunks are longer
+    "n_results": 32,
+    # chunk size and overlap with the previous chunk, in tokens
+    "chunk_tokens": 256,
+    "chunk_overlap_tokens": 32,
     "chroma_db_path": "./chroma_db",
     "chroma_db_collection": "doc_collection",
+    # chunks per embedding request, embedding requests in flight and chunks per upsert
+    "embed_batch_size": 64,
+    "embed_max_concurrency": 4,
+    "upsert_batch_size": 1000,
+    # token budget for the retrieved chunks sent with each message
+    "retrieval_token_budget": 8000,
+    # fuse BM25 keyword matches with the vector matches; each retriever returns
+    # n_results * hybrid_candidates chunks before reciprocal rank fusion
+    "hybrid": True,
+    "hybrid_candidates": 4,
+    "rrf_k": 60,
+}
+
+ingestion_config = {
+    # size of the process pool used to extract PDF pages
+    "max_workers": int(os.getenv("INGESTION_MAX_WORKERS", os.cpu_count() or 1)),
+    "pages_per_task": 25,
+    # files larger than the context budget can take are streamed into the
+    # context page by page instead of parsed in full: above budget tokens
+    # times this many bytes, PDF files being larger than their text
+    "stream_bytes_per_token": 8,
+    # files above this size are always streamed
+    "stream_threshold_bytes": 64 * 1024**2,
+    # uploaded files ingested in the background at the same time
+    "background_workers": 4,
+}
+
+cache_config = {
+    "path": "./cache",
+    "parse_cache_max_bytes": 512 * 1024**2,
+    "response_cache": True,
+    "response_cache_max_bytes": 256 * 1024**2,
+    "response_cache_ttl": 24 * 3600,
+    # also answer near-identical questions from the cache
+    "semantic_cache": False,
+    "semantic_cache_threshold": 0.95,
+}
+
+# context window of each chat model in tokens
+context_windows = {
+    "gemini": 1_000_000,
+    "gpt-4o": 128_000,
+    "o1-preview": 128_000,
+}
+# models that can answer chat requests, sorted by priority
+chat_models = [m for m in available_models if m in context_windows]
+
+dispatch_config = {
+    # seconds without progress before a request to a model is abandoned
+    "timeout": {"gemini": 60, "gpt-4o": 60, "o1-preview": 300},
+    # retries of a model on 429, 5xx and timeouts before failing over
+    "max_retries": 2,
+    "backoff_base": 0.5,
+    "backoff_max": 8.0,
+    # try the next model of chat_models when a model keeps failing
+    "failover": True,
+    # start the next model too if the first token is later than the
+    # hedge_quantile of the model's observed first token latencies
+    "hedge": False,
+    "hedge_quantile": 0.95,
+    "hedge_min_samples": 20,
+    "hedge_default_deadline": 10.0,
+}
+
+rate_limit_config = {
+    # requests and tokens per minute of each deployment, unset for no limit
+    "limits": {
+        "gemini": {
+            "rpm": int(os.getenv("GEMINI_RPM", 0)),
+            "tpm": int(os.getenv("GEMINI_TPM", 0)),
+        },
+        "gpt-4o": {
+            "rpm": int(os.getenv("GPT4O_RPM", 0)),
+            "tpm": int(os.getenv("GPT4O_TPM", 0)),
+        },
+        "o1-preview": {
+            "rpm": int(os.getenv("O1_RPM", 0)),
+            "tpm": int(os.getenv("O1_TPM", 0)),
+        },
+        "text-embedding-3-large": {
+            "rpm": int(os.getenv("EMBEDDING_RPM", 0)),
+            "tpm": int(os.getenv("EMBEDDING_TPM", 0)),
+        },
+    },
+    # seconds a model is held back after a 429 without a Retry-After header
+    "pause_on_429": 5.0,
+}
+
+batch_config = {
+    # requests of the batch runner in flight; their rate is set by rate_limit_config
+    "max_concurrency": 8,
+    # documents parsed at the same time before the questions are sent
+    "ingest_workers": 4,
+}
+
+pipeline_config = {
+    # independent steps of pipeline.py run at the same time
+    "max_workers": 4,
+    "cache_max_bytes": 128 * 1024**2,
+}
+
+sandbox_config = {
+    # worker processes running generated code, started with these modules imported
+    "workers": 2,
+    "preload": ["pandas", "matplotlib.pyplot"],
+    # limits of one execution; a worker past wall_seconds is killed and replaced
+    "cpu_seconds": 10,
+    "wall_seconds": 30,
+    # address space a worker may use on top of the preloaded modules
+    "memory_bytes": 1024**3,
+    "file_bytes": 64 * 1024**2,
+    # workers are replaced after this many executions, dropping leftover state
+    "max_tasks": 100,
+    "startup_seconds": 60,
+}
+
+history_config = {
+    # fold messages that don't fit the history budget into a summary
+    "summary": True,
+    "summary_max_tokens": 500,
+    # messages folded at a time, so the summary changes only every few turns
+    "fold_batch": 4,
 }
 
-pdf_size_token_limit = 400000
+system_prompt = (
+    "You are a helpful assistant. Answer questions using the provided "
+    "documents when they are relevant."
+)
+
+gemini_context_cache_config = {
+    # upload the document context once and refer to it on later turns
+    "enabled": False,
+    "ttl": 3600,
+    # contexts below the provider's minimum size for caching are sent inline
+    "min_tokens": 4096,
+}
+
+telemetry_config = {
+    # port of the Prometheus /metrics endpoint, 0 disables it
+    "metrics_port": int(os.getenv("METRICS_PORT", 0)),
+    # JSONL file every span is appended to, unset disables it
+    "trace_log": os.getenv("TRACE_LOG"),
+    # histogram buckets of the span durations, in seconds
+    "buckets": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+    # recent durations per span and model the p50/p95/p99 are computed from
+    "quantile_window": 1000,
+}
+
+warmup_config = {
+    # build clients, tokenizers and indexes once the server is listening,
+    # instead of in the first request
+    "enabled": os.getenv("WARMUP", "1") == "1",
+    "chroma": True,
+    "process_pool": True,
+}
+
+# tokens kept free for the answer
+completion_token_reserve = 4096
+# maximum share of the prompt budget taken by the conversation history
+history_token_share = 0.25
+
+# rough conversion used to estimate tokens from character counts
+chars_per_token = 4
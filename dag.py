@@ -0,0 +1,199 @@
+import hashlib
+import inspect
+import json
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from filecache import FileCache
+from telemetry import tracer
+
+
+@dataclass
+class Step:
+    """
+    One step of a pipeline.
+
+    The function is called with the inputs as keyword arguments and the
+    result of every dependency under the dependency's name.
+
+    Attributes:
+        name: Name of the step, unique in its pipeline
+        func: Function computing the result
+        depends: Names of the steps whose results the function takes
+        inputs: Further arguments, e.g. a prompt or a model name
+        cache: Memoize the result; off for steps with side effects or unpicklable results
+        version: Bump to invalidate cached results when func depends on more than its source
+    """
+
+    name: str
+    func: Callable[..., Any]
+    depends: List[str] = field(default_factory=list)
+    inputs: Dict[str, Any] = field(default_factory=dict)
+    cache: bool = True
+    version: str = "1"
+
+
+def _source(func: Callable[..., Any]) -> str:
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        # builtins and functions defined in the interpreter
+        return getattr(func, "__qualname__", repr(func))
+
+
+class Pipeline:
+    """
+    Runs steps in dependency order, independent steps concurrently.
+
+    Results are memoized under a hash of the step's source, version and
+    inputs, and the hashes of its dependencies. Editing a prompt therefore
+    recomputes that step and the steps downstream of it, while everything
+    else is read from the cache.
+
+    Attributes:
+        steps: Steps by name
+        cache: Cache of the step results, None disables memoization
+        max_workers: Steps run at the same time
+    """
+
+    def __init__(
+        self, steps: Iterable[Step], cache: Optional[FileCache] = None, max_workers: int = 4
+    ):
+        self.steps: Dict[str, Step] = {}
+        for step in steps:
+            self.add(step)
+        self.cache = cache
+        self.max_workers = max_workers
+
+    def add(self, step: Step) -> None:
+        if step.name in self.steps:
+            raise ValueError(f"Duplicate step {step.name}")
+        self.steps[step.name] = step
+
+    def order(self, targets: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Return the targets and the steps they depend on, dependencies first.
+
+        Args:
+            targets: Names of the steps wanted, all steps by default
+
+        Returns:
+            Names of the steps in topological order
+        """
+        ordered: List[str] = []
+        visiting: Set[str] = set()
+
+        def visit(name: str, path: List[str]):
+            if name in ordered:
+                return
+            if name not in self.steps:
+                needed_by = f" needed by {path[-1]}" if path else ""
+                raise KeyError(f"Unknown step {name}{needed_by}")
+            if name in visiting:
+                raise ValueError("Dependency cycle: " + " -> ".join(path + [name]))
+            visiting.add(name)
+            for dependency in self.steps[name].depends:
+                visit(dependency, path + [name])
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in targets or self.steps:
+            visit(name, [])
+        return ordered
+
+    def keys(self, names: List[str]) -> Dict[str, str]:
+        """Return the cache key of every step, names in topological order"""
+        keys: Dict[str, str] = {}
+        for name in names:
+            step = self.steps[name]
+            payload = json.dumps(
+                [
+                    step.name,
+                    step.version,
+                    _source(step.func),
+                    step.inputs,
+                    [keys[d] for d in step.depends],
+                ],
+                sort_keys=True,
+                default=repr,
+            )
+            keys[name] = f"step:{name}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+        return keys
+
+    def _run_step(self, step: Step, key: str, results: Dict[str, Any], force: bool) -> Any:
+        with tracer.span("pipeline_step", step=step.name) as span:
+            memoized = step.cache and self.cache is not None
+            if memoized and not force:
+                # None is not a valid result to cache, it marks a miss
+                cached = self.cache.get(key)
+                if cached is not None:
+                    span.set(cache="hit")
+                    return cached
+            if memoized:
+                span.set(cache="miss")
+
+            kwargs = {**step.inputs, **{d: results[d] for d in step.depends}}
+            result = step.func(**kwargs)
+            if memoized and result is not None:
+                try:
+                    self.cache.set(key, result)
+                except Exception as e:
+                    # e.g. a result that can't be pickled, it's recomputed next time
+                    print(f"Could not cache the result of {step.name}: {e}")
+            return result
+
+    def run(
+        self, targets: Optional[Iterable[str]] = None, force: Iterable[str] = ()
+    ) -> Dict[str, Any]:
+        """
+        Compute the targets and their dependencies.
+
+        A step is submitted as soon as all its dependencies are done. When a
+        step fails, no further steps are started and the error is raised
+        once the running ones have finished.
+
+        Args:
+            targets: Names of the steps wanted, all steps by default
+            force: Names of steps to recompute, with the steps downstream of them,
+                even if their results are cached
+
+        Returns:
+            Result of every step that ran or came from the cache, by name
+        """
+        names = self.order(targets)
+        keys = self.keys(names)
+        force = set(force)
+        for name in names:
+            if force & set(self.steps[name].depends):
+                force.add(name)
+        results: Dict[str, Any] = {}
+        pending = list(names)
+        running: Dict[Future, str] = {}
+        error: Optional[BaseException] = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [n for n in pending if set(self.steps[n].depends) <= results.keys()]
+                for name in ready if error is None else []:
+                    pending.remove(name)
+                    step = self.steps[name]
+                    future = executor.submit(
+                        self._run_step, step, keys[name], dict(results), name in force
+                    )
+                    running[future] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print(f"Step {name} failed: {e}")
+                        error = error or e
+
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,492 @@
+import asyncio
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from config import chat_models, dispatch_config
+from llm import LLM
+from request import Response
+from telemetry import Span, tracer
+
+# prepare(model) returns the context, history and budget report for a model
+Prepare = Callable[[str], Tuple[Optional[str], List[dict], Dict[str, Any]]]
+
+
+class FirstTokenError(Exception):
+    """Raised when no model of a hedged request produced a first token"""
+
+
+class LatencyTracker:
+    """
+    Keeps the most recent first token latencies of each model.
+
+    Attributes:
+        size: Number of samples kept per model
+    """
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.size)).append(seconds)
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        """Return the q-quantile of the model's latencies, None without enough samples"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < dispatch_config["hedge_min_samples"]:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+latency_tracker = LatencyTracker()
+
+
+def failover_order(model: str) -> List[str]:
+    if not dispatch_config["failover"]:
+        return [model]
+    return [model] + [m for m in chat_models if m != model]
+
+
+def is_retryable(error: Exception) -> bool:
+    """Return whether an error is worth retrying: timeouts, connection errors, 429 and 5xx"""
+    import httpx
+    import openai
+
+    if isinstance(
+        error,
+        (openai.APITimeoutError, openai.APIConnectionError, httpx.TransportError, TimeoutError),
+    ):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter keeps retrying clients from synchronizing
+    cap = min(dispatch_config["backoff_max"], dispatch_config["backoff_base"] * 2**attempt)
+    return random.uniform(0, cap)
+
+
+def hedge_deadline(model: str) -> float:
+    deadline = latency_tracker.quantile(model, dispatch_config["hedge_quantile"])
+    return deadline if deadline is not None else dispatch_config["hedge_default_deadline"]
+
+
+def _attempts(model: str) -> Iterator[Tuple[str, int]]:
+    for candidate in failover_order(model):
+        for attempt in range(dispatch_config["max_retries"] + 1):
+            yield candidate, attempt
+
+
+def _end_request_span(
+    span: Span, response: Optional[Response], error: Optional[BaseException] = None
+) -> None:
+    if response is not None:
+        usage = response.token_usage
+        span.set(
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            cached_tokens=usage.get("cached_tokens", 0),
+        )
+    span.end(error)
+
+
+def memoize_prepare(prepare: Prepare) -> Prepare:
+    prepared = {}
+
+    def wrapper(model: str):
+        if model not in prepared:
+            prepared[model] = prepare(model)
+        return prepared[model]
+
+    return wrapper
+
+
+def dispatch(
+    handlers: Dict[str, Callable[..., Response]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> Response:
+    """
+    Send a request, retrying with jittered backoff and failing over to the next model.
+
+    Args:
+        handlers: Request handler of each model
+        get_client: Returns the client of a model
+        prepare: Returns the context, history and budget report for a model
+        message: The user's message
+        model: Model to try first
+
+    Returns:
+        Response of the first model that answered
+    """
+    prepare = memoize_prepare(prepare)
+    error = None
+    for candidate, attempt in _attempts(model):
+        if attempt:
+            time.sleep(backoff_delay(attempt - 1))
+
+        context, history, budget = prepare(candidate)
+        span = tracer.start_span("llm_request", model=candidate, stream=False)
+        try:
+            response = handlers[candidate](
+                get_client(candidate), message, history, candidate, context
+            )
+        except Exception as e:
+            _end_request_span(span, None, e)
+            if not is_retryable(e):
+                raise
+            error = e
+            continue
+        _end_request_span(span, response)
+
+        response.budget = budget
+        response.model = candidate
+        return response
+
+    raise error
+
+
+def _stream_once(
+    handlers: Dict[str, Callable[..., Iterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> Iterator[Response]:
+    context, history, budget = prepare(model)
+    span = tracer.start_span("llm_request", model=model, stream=True)
+    start = time.monotonic()
+    response = None
+    try:
+        for response in handlers[model](get_client(model), message, history, model, context):
+            if span.attributes.get("ttft") is None:
+                latency_tracker.record(model, time.monotonic() - start)
+                span.set(ttft=time.monotonic() - start)
+            response.budget = budget
+            response.model = model
+            yield response
+    except BaseException as e:
+        _end_request_span(span, response, e)
+        raise
+    _end_request_span(span, response)
+
+
+def _hedged_stream(
+    handlers: Dict[str, Callable[..., Iterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    models: List[str],
+) -> Iterator[Response]:
+    """
+    Stream from models[0] and also start models[1] if the first token is late.
+
+    The model that produces the first token wins and the other is stopped.
+    Raises FirstTokenError if both fail before their first token.
+    """
+    events: queue.Queue = queue.Queue()
+    stops = {model: threading.Event() for model in models}
+
+    def pump(model: str):
+        stream = _stream_once(handlers, get_client, prepare, message, model)
+        try:
+            for response in stream:
+                if stops[model].is_set():
+                    break
+                events.put((model, "response", response))
+            events.put((model, "done", None))
+        except Exception as e:
+            events.put((model, "error", e))
+        finally:
+            stream.close()
+
+    def start(model: str):
+        threading.Thread(target=pump, args=(model,), daemon=True).start()
+
+    primary, secondary = models[0], models[1]
+    start(primary)
+    started = [primary]
+    deadline = time.monotonic() + hedge_deadline(primary)
+    winner = None
+    failed = []
+
+    while True:
+        timeout = None
+        if secondary not in started:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            model, kind, value = events.get(timeout=timeout)
+        except queue.Empty:
+            start(secondary)
+            started.append(secondary)
+            continue
+
+        if winner is None:
+            if kind == "error":
+                failed.append(value)
+                if len(failed) == len(started) and secondary in started:
+                    raise FirstTokenError() from value
+                if secondary not in started:
+                    start(secondary)
+                    started.append(secondary)
+                continue
+            winner = model
+            for other in started:
+                if other != winner:
+                    stops[other].set()
+
+        if model != winner:
+            continue
+        if kind == "response":
+            yield value
+        elif kind == "done":
+            return
+        else:
+            raise value
+
+
+def dispatch_stream(
+    handlers: Dict[str, Callable[..., Iterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> Iterator[Response]:
+    """
+    Stream a response with retries, failover and optional hedging.
+
+    Errors before the first token are retried or failed over like in
+    dispatch; once tokens were streamed, errors are raised.
+
+    Args:
+        handlers: Streaming request handler of each model
+        get_client: Returns the client of a model
+        prepare: Returns the context, history and budget report for a model
+        message: The user's message
+        model: Model to try first
+
+    Yields:
+        Response with the text received so far
+    """
+    prepare = memoize_prepare(prepare)
+    models = failover_order(model)
+    if dispatch_config["hedge"] and len(models) > 1:
+        try:
+            yield from _hedged_stream(handlers, get_client, prepare, message, models[:2])
+            return
+        except FirstTokenError:
+            pass
+
+    error = None
+    for candidate, attempt in _attempts(model):
+        if attempt:
+            time.sleep(backoff_delay(attempt - 1))
+
+        streamed = False
+        try:
+            for response in _stream_once(handlers, get_client, prepare, message, candidate):
+                streamed = True
+                yield response
+            return
+        except Exception as e:
+            if streamed or not is_retryable(e):
+                raise
+            error = e
+
+    raise error
+
+
+async def dispatch_async(
+    handlers: Dict[str, Callable[..., Any]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> Response:
+    """
+    Async variant of dispatch; prepare runs in a worker thread.
+    """
+    prepare = memoize_prepare(prepare)
+    error = None
+    for candidate, attempt in _attempts(model):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt - 1))
+
+        context, history, budget = await asyncio.to_thread(prepare, candidate)
+        span = tracer.start_span("llm_request", model=candidate, stream=False)
+        try:
+            response = await handlers[candidate](
+                get_client(candidate), message, history, candidate, context
+            )
+        except Exception as e:
+            _end_request_span(span, None, e)
+            if not is_retryable(e):
+                raise
+            error = e
+            continue
+        _end_request_span(span, response)
+
+        response.budget = budget
+        response.model = candidate
+        return response
+
+    raise error
+
+
+async def _stream_once_async(
+    handlers: Dict[str, Callable[..., AsyncIterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> AsyncIterator[Response]:
+    context, history, budget = await asyncio.to_thread(prepare, model)
+    span = tracer.start_span("llm_request", model=model, stream=True)
+    start = time.monotonic()
+    response = None
+    try:
+        async for response in handlers[model](
+            get_client(model), message, history, model, context
+        ):
+            if span.attributes.get("ttft") is None:
+                latency_tracker.record(model, time.monotonic() - start)
+                span.set(ttft=time.monotonic() - start)
+            response.budget = budget
+            response.model = model
+            yield response
+    except BaseException as e:
+        _end_request_span(span, response, e)
+        raise
+    _end_request_span(span, response)
+
+
+async def _hedged_stream_async(
+    handlers: Dict[str, Callable[..., AsyncIterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    models: List[str],
+) -> AsyncIterator[Response]:
+    """
+    Async variant of _hedged_stream; the losing stream's task is cancelled.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def pump(model: str):
+        try:
+            async for response in _stream_once_async(
+                handlers, get_client, prepare, message, model
+            ):
+                await events.put((model, "response", response))
+            await events.put((model, "done", None))
+        except Exception as e:
+            await events.put((model, "error", e))
+
+    def start(model: str):
+        tasks[model] = asyncio.create_task(pump(model))
+
+    primary, secondary = models[0], models[1]
+    start(primary)
+    deadline = time.monotonic() + hedge_deadline(primary)
+    winner = None
+    failed = []
+
+    try:
+        while True:
+            timeout = None
+            if secondary not in tasks:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                model, kind, value = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                start(secondary)
+                continue
+
+            if winner is None:
+                if kind == "error":
+                    failed.append(value)
+                    if len(failed) == len(tasks) and secondary in tasks:
+                        raise FirstTokenError() from value
+                    if secondary not in tasks:
+                        start(secondary)
+                    continue
+                winner = model
+                for other, task in tasks.items():
+                    if other != winner:
+                        task.cancel()
+
+            if model != winner:
+                continue
+            if kind == "response":
+                yield value
+            elif kind == "done":
+                return
+            else:
+                raise value
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+async def dispatch_stream_async(
+    handlers: Dict[str, Callable[..., AsyncIterator[Response]]],
+    get_client: Callable[[str], LLM],
+    prepare: Prepare,
+    message: str,
+    model: str,
+) -> AsyncIterator[Response]:
+    """
+    Async variant of dispatch_stream.
+    """
+    prepare = memoize_prepare(prepare)
+    models = failover_order(model)
+    if dispatch_config["hedge"] and len(models) > 1:
+        try:
+            async for response in _hedged_stream_async(
+                handlers, get_client, prepare, message, models[:2]
+            ):
+                yield response
+            return
+        except FirstTokenError:
+            pass
+
+    error = None
+    for candidate, attempt in _attempts(model):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt - 1))
+
+        streamed = False
+        try:
+            async for response in _stream_once_async(
+                handlers, get_client, prepare, message, candidate
+            ):
+                streamed = True
+                yield response
+            return
+        except Exception as e:
+            if streamed or not is_retryable(e):
+                raise
+            error = e
+
+    raise error
@@ -1,67 +1,336 @@
 import os
-from functools import reduce
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from functools import cache
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-import chromadb
-from chromadb.utils import embedding_functions
-from pypdf import PdfReader
+from bm25 import BM25Index, reciprocal_rank_fusion
+from config import cache_config, model_config, vector_db_config
+from pdfparser import Document, file_digest, process_file, process_files
+from ratelimit import EMBEDDING, rate_limiter, request_priority
+from telemetry import tracer
+from tokens import count_tokens
 
-from config import model_config, vector_db_config
-from pdfparser import Document, extract_pdf_text_by_page
 
+def rate_limited(embedding_function, model: str):
+    """Wrap an embedding function so its requests wait for quota in the rate limiter"""
 
-if model_config["text-embedding-3-large"]["azure_endpoint"]:
-    embedding = model_config["text-embedding-3-large"]
+    def embed(input):
+        estimate = sum(count_tokens(text, model) for text in input)
+        rate_limiter.acquire(model, estimate)
+        return embedding_function(input)
+
+    return embed
 
-    embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=embedding["api_key"],
-        api_base=embedding["azure_endpoint"],
-        api_type="azure",
-        api_version=embedding["api_version"],
-        model_name=embedding["api_model"],
-    )
-else:
-    embedding_function = embedding_functions.DefaultEmbeddingFunction()
 
+@cache
+def get_embedding_function():
+    """
+    Return the embedding function, building it on first use.
 
-client = chromadb.Client()
+    Chroma and the embedding model are imported here rather than at module
+    import, which keeps the start of the application fast.
 
-collection = client.get_or_create_collection(
-    name="my_collection", embedding_function=embedding_function
-)
+    Returns:
+        The embedding function, with vectors cached on disk
+    """
+    from chromadb.utils import embedding_functions
 
+    from embeddingcache import CachedEmbeddingFunction, EmbeddingStore
 
-def add_document(collection, document: Document):
-    existing = collection.get(ids=[document.id])
-    if document.id not in existing["ids"]:
-        # ID already exists, skip adding
-        collection.add(
-            documents=[document.text],
-            ids=[document.id],
-            metadatas=[{"page": document.page}],
+    if model_config["text-embedding-3-large"]["azure_endpoint"]:
+        embedding = model_config["text-embedding-3-large"]
+
+        embedding_function = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=embedding["api_key"],
+            api_base=embedding["azure_endpoint"],
+            api_type="azure",
+            api_version=embedding["api_version"],
+            model_name=embedding["api_model"],
         )
-    return collection
+        embedding_function = rate_limited(embedding_function, "text-embedding-3-large")
+        embedding_model_name = embedding["api_model"]
+    else:
+        embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        embedding_model_name = "all-MiniLM-L6-v2"
+
+    # vectors are reused across collections and document versions with the same text
+    return CachedEmbeddingFunction(
+        embedding_function,
+        embedding_model_name,
+        EmbeddingStore(os.path.join(cache_config["path"], "embeddings")),
+    )
 
 
-def embed_documents_to_chroma(
-    documents: List[Document],
+@cache
+def get_collection(
     collection_name=vector_db_config["chroma_db_collection"],
     chroma_path=vector_db_config["chroma_db_path"],
 ):
+    """
+    Return the persistent Chroma collection, creating it on first use.
+
+    Args:
+        collection_name: Name of the Chroma collection
+        chroma_path: Directory of the persistent Chroma database
+
+    Returns:
+        The Chroma collection
+    """
+    import chromadb
+
     client = chromadb.PersistentClient(path=chroma_path)
-    collection = client.get_or_create_collection(
-        name=collection_name, embedding_function=embedding_function
+    return client.get_or_create_collection(
+        name=collection_name, embedding_function=get_embedding_function()
     )
 
-    reduce(
-        lambda col, doc: add_document(col, doc),
-        documents,
-        collection,
+
+@cache
+def get_bm25_index(
+    collection_name=vector_db_config["chroma_db_collection"],
+    chroma_path=vector_db_config["chroma_db_path"],
+) -> BM25Index:
+    """Return the BM25 index kept next to the persistent Chroma collection"""
+    return BM25Index(os.path.join(chroma_path, f"bm25_{collection_name}.sqlite"))
+
+
+def upsert_documents(
+    collection,
+    documents: List[Document],
+    digest: str,
+    batch_size: int = vector_db_config["embed_batch_size"],
+    max_concurrency: int = vector_db_config["embed_max_concurrency"],
+    upsert_batch_size: int = vector_db_config["upsert_batch_size"],
+) -> int:
+    """
+    Add the documents that are not in the collection yet, in batches.
+
+    The ids are checked against the collection in one query, only the
+    missing chunks are embedded, and the results are upserted in large
+    batches, so re-running on the same documents is cheap and idempotent.
+
+    Args:
+        collection: Chroma collection
+        documents: Documents to add
+        digest: Content digest of the file the documents come from
+        batch_size: Number of chunks per embedding request
+        max_concurrency: Maximum number of embedding requests in flight
+        upsert_batch_size: Number of chunks per upsert
+
+    Returns:
+        Number of chunks that were added
+    """
+    # later duplicates of an id are dropped
+    unique = {}
+    for document in documents:
+        unique.setdefault(document.id, document)
+    documents = list(unique.values())
+    if not documents:
+        return 0
+
+    existing = set(collection.get(ids=[d.id for d in documents], include=[])["ids"])
+    missing = [d for d in documents if d.id not in existing]
+    if not missing:
+        return 0
+
+    embedding_function = get_embedding_function()
+
+    def embed(batch: List[Document]):
+        # bulk embedding queues behind chat requests for the shared quota
+        request_priority.set(EMBEDDING)
+        return embedding_function([d.text for d in batch])
+
+    batches = [missing[i : i + batch_size] for i in range(0, len(missing), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        embedded = pool.map(embed, batches)
+        embeddings = [vector for batch in embedded for vector in batch]
+
+    for i in range(0, len(missing), upsert_batch_size):
+        batch = missing[i : i + upsert_batch_size]
+        collection.upsert(
+            ids=[d.id for d in batch],
+            documents=[d.text for d in batch],
+            embeddings=embeddings[i : i + upsert_batch_size],
+            metadatas=[
+                {
+                    "document": d.document,
+                    "digest": digest,
+                    "page": d.page,
+                    "start": d.start,
+                    "end": d.end,
+                }
+                for d in batch
+            ],
+        )
+
+    return len(missing)
+
+
+def scope_documents(documents: List[Document], digest: str) -> List[Document]:
+    """
+    Prefix the chunk ids with the content digest of their file.
+
+    The collection is shared by all sessions, so chunks are keyed and
+    filtered by the file's content rather than its name: another upload
+    with the same name, or an older version of the file, never ends up in
+    the context.
+    """
+    return [replace(d, id=f"{digest[:16]}_{d.id}") for d in documents]
+
+
+# (chroma path, collection, digest) of the files embedded in full by this process
+_embedded_digests: Set[Tuple[str, str, str]] = set()
+
+
+def is_embedded(
+    digest: str,
+    collection_name=vector_db_config["chroma_db_collection"],
+    chroma_path=vector_db_config["chroma_db_path"],
+) -> bool:
+    """Return whether the file with this content digest was embedded since the start"""
+    return (chroma_path, collection_name, digest) in _embedded_digests
+
+
+def embed_documents_to_chroma(
+    documents: List[Document],
+    digest: str,
+    collection_name=vector_db_config["chroma_db_collection"],
+    chroma_path=vector_db_config["chroma_db_path"],
+) -> int:
+    collection = get_collection(collection_name, chroma_path)
+    documents = scope_documents(documents, digest)
+
+    with tracer.span("embed", chunks=len(documents)) as span:
+        added = upsert_documents(collection, documents, digest)
+        # chunks embedded before the index existed are picked up here as well
+        get_bm25_index(collection_name, chroma_path).add(documents, digest)
+        span.set(embedded=added)
+    _embedded_digests.add((chroma_path, collection_name, digest))
+    return added
+
+
+def _to_documents(ids, texts, metadatas) -> List[Document]:
+    return [
+        Document(
+            document=metadata["document"],
+            page=metadata["page"],
+            text=text,
+            id=id,
+            start=metadata.get("start", 0),
+            end=metadata.get("end", 0),
+        )
+        for id, text, metadata in zip(ids, texts, metadatas)
+    ]
+
+
+def query_documents(
+    query: str,
+    digests: List[str],
+    n_results: int = vector_db_config["n_results"],
+    collection=None,
+    bm25_index: Optional[BM25Index] = None,
+    hybrid: bool = vector_db_config["hybrid"],
+) -> List[Document]:
+    """
+    Return the chunks most relevant to the query, restricted to the given documents.
+
+    With hybrid retrieval the vector matches and the BM25 keyword matches
+    are merged by reciprocal rank fusion, so chunks containing the exact
+    identifiers of the query (ISINs, tickers, dates, figures) are found
+    even when their embeddings are not the closest.
+
+    Args:
+        query: Text to search for
+        digests: Content digests of the files to search in
+        n_results: Number of chunks to return
+        collection: Chroma collection, defaults to the persistent collection
+        bm25_index: BM25 index of the collection, defaults to the persistent index
+        hybrid: Whether to fuse the vector matches with BM25 matches
+
+    Returns:
+        List of Document objects ordered by relevance
+    """
+    collection = collection or get_collection()
+    n_candidates = n_results * vector_db_config["hybrid_candidates"] if hybrid else n_results
+    result = collection.query(
+        query_texts=[query],
+        n_results=n_candidates,
+        where={"digest": {"$in": digests}},
     )
+    dense = _to_documents(result["ids"][0], result["documents"][0], result["metadatas"][0])
+    if not hybrid:
+        return dense
+
+    bm25_index = bm25_index or get_bm25_index()
+    sparse = [id for id, _ in bm25_index.search(query, n_candidates, digests)]
+    ranked = reciprocal_rank_fusion(
+        [[d.id for d in dense], sparse], k=vector_db_config["rrf_k"]
+    )[:n_results]
+
+    chunks = {d.id: d for d in dense}
+    missing = [id for id in ranked if id not in chunks]
+    if missing:
+        result = collection.get(ids=missing, include=["documents", "metadatas"])
+        for d in _to_documents(result["ids"], result["documents"], result["metadatas"]):
+            chunks[d.id] = d
+    return [chunks[id] for id in ranked if id in chunks]
+
+
+def create_retrieval_context(
+    files: List[str],
+    query: str,
+    model: str,
+    n_results: int = vector_db_config["n_results"],
+    token_budget: int = vector_db_config["retrieval_token_budget"],
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """
+    Build a context from the chunks of the files that are most relevant to the query.
+
+    Args:
+        files: List of uploaded files
+        query: The user's message
+        model: Model whose tokenizer is used for counting
+        n_results: Number of chunks to retrieve
+        token_budget: Maximum number of tokens of retrieved text
+
+    Returns:
+        Tuple of the context string, or None if no files are given, and a
+        budget report
+    """
+    report = {"context_budget": token_budget, "context_tokens": 0, "chunks": 0}
+    if not files:
+        return None, report
+
+    digests = [file_digest(f) for f in files]
+    # files are usually embedded at upload already, only the others are parsed here
+    pending = [(f, d) for f, d in zip(files, digests) if not is_embedded(d)]
+    if pending:
+        parsed = process_files([f for f, _ in pending])
+        for documents, (_, digest) in zip(parsed, pending):
+            embed_documents_to_chroma(documents, digest)
+
+    with tracer.span("retrieve", model=model, files=len(files)) as span:
+        chunks = query_documents(query, digests, n_results)
+
+        texts = []
+        for chunk in chunks:
+            text = f"[{chunk.document}, page {chunk.page}]\n{chunk.text}"
+            tokens = count_tokens(text, model)
+            if report["context_tokens"] + tokens > token_budget:
+                break
+            texts.append(text)
+            report["context_tokens"] += tokens
+            report["chunks"] += 1
+        span.set(chunks=report["chunks"], context_tokens=report["context_tokens"])
+
+    retrieved_text = "\n\n".join(texts)
+
+    context = f"Use this information to answer questions:\n{retrieved_text}"
+    return context, report
 
 
 if __name__ == "__main__":
     file_path = "test_sample.pdf"  # Replace with your PDF or TXT file path
     documents = process_file(file_path)
     chroma_path = "./chroma_db"
-    embed_documents_to_chroma(documents, chroma_path=chroma_path)
+    embed_documents_to_chroma(documents, file_digest(file_path), chroma_path=chroma_path)
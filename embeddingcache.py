@@ -0,0 +1,189 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+
+class EmbeddingStore:
+    """
+    On-disk store of float32 vectors keyed by (model name, sha256 of text).
+
+    Vectors are appended to one raw float32 file per dimension and read
+    back through a memory map; a SQLite index maps each key to its row.
+    Writers are serialized by the SQLite lock, so several processes can
+    share a store.
+
+    Attributes:
+        path: Directory of the store
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+        os.makedirs(path, exist_ok=True)
+        with self._connection() as con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS vectors (
+                    key TEXT PRIMARY KEY,
+                    dim INTEGER NOT NULL,
+                    row INTEGER NOT NULL
+                )
+                """
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(
+                os.path.join(self.path, "index.sqlite"),
+                timeout=30,
+                isolation_level=None,
+            )
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def _vector_file(self, dim: int) -> str:
+        return os.path.join(self.path, f"vectors_{dim}.f32")
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return f"{model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up vectors by key.
+
+        Args:
+            keys: Keys created with EmbeddingStore.key
+
+        Returns:
+            Dictionary of the keys that were found and their vectors
+        """
+        rows = {}
+        con = self._connection()
+        # stay well below the sqlite limit of bound variables
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            rows.update(
+                (key, (dim, row))
+                for key, dim, row in con.execute(
+                    f"SELECT key, dim, row FROM vectors WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+
+        vectors = {}
+        for dim in {dim for dim, _ in rows.values()}:
+            matrix = np.memmap(self._vector_file(dim), dtype=np.float32, mode="r")
+            matrix = matrix.reshape(-1, dim)
+            for key, (key_dim, row) in rows.items():
+                if key_dim == dim:
+                    vectors[key] = np.array(matrix[row])
+        return vectors
+
+    def put_many(self, vectors: Dict[str, np.ndarray]) -> None:
+        """
+        Append vectors to the store, skipping keys that are already stored.
+
+        Args:
+            vectors: Dictionary of keys and vectors
+        """
+        by_dim: Dict[int, Dict[str, np.ndarray]] = {}
+        for key, vector in vectors.items():
+            vector = np.asarray(vector, dtype=np.float32).ravel()
+            by_dim.setdefault(vector.shape[0], {})[key] = vector
+
+        con = self._connection()
+        for dim, dim_vectors in by_dim.items():
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                stored = {
+                    key
+                    for (key,) in con.execute(
+                        f"SELECT key FROM vectors WHERE key IN ({','.join('?' * len(dim_vectors))})",
+                        list(dim_vectors),
+                    )
+                }
+                new = {k: v for k, v in dim_vectors.items() if k not in stored}
+
+                path = self._vector_file(dim)
+                first_row = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+                with open(path, "ab") as f:
+                    f.write(np.stack(list(new.values())).tobytes() if new else b"")
+
+                con.executemany(
+                    "INSERT INTO vectors (key, dim, row) VALUES (?, ?, ?)",
+                    [(key, dim, first_row + i) for i, key in enumerate(new)],
+                )
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Embedding function that looks vectors up in an EmbeddingStore before
+    calling the wrapped embedding function for the texts it hasn't seen.
+
+    Attributes:
+        embedding_function: The wrapped embedding function
+        model_name: Name of the embedding model, part of the cache key
+        store: Store holding the vectors
+        hits: Number of texts served from the store
+        misses: Number of texts sent to the wrapped embedding function
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        model_name: str,
+        store: EmbeddingStore,
+    ):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [EmbeddingStore.key(self.model_name, text) for text in input]
+        vectors = self.store.get_many(keys)
+
+        # embed every missing text once, even if it occurs several times
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, input):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        if missing:
+            embedded = self.embedding_function(list(missing.values()))
+            new = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(missing, embedded)
+            }
+            self.store.put_many(new)
+            vectors.update(new)
+
+        with self._lock:
+            self.hits += len(input) - len(missing)
+            self.misses += len(missing)
+
+        return [vectors[key] for key in keys]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Return the hit and miss counters and the hit ratio"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else None,
+        }
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Azure OpenAI and Gemini endpoints, for benchmarks.
+
+Answers chat completions, streamed or not, and embeddings for any
+deployment, and Gemini generateContent and streamGenerateContent for any
+model, with a configurable first byte latency, token rate and error
+rate. Answers are generated text; embeddings are deterministic per text.
+
+Usage:
+    python fakeserver.py --port 8900 --latency 0.2 --tokens-per-second 50
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+WORDS = (
+    "the bond pays a fixed coupon until maturity and the issuer may call it "
+    "at par after five years subject to the terms of the prospectus"
+).split()
+
+
+@dataclass
+class FakeSettings:
+    """
+    Behaviour of the fake endpoints.
+
+    Attributes:
+        latency: Seconds before the first byte of a response
+        tokens_per_second: Rate at which answer tokens are streamed, 0 for no delay
+        answer_tokens: Number of tokens of each answer
+        error_rate: Share of requests answered with an error
+        error_status: HTTP status of those errors, e.g. 429 or 500
+        embedding_dim: Dimension of the embeddings
+        seed: Seed of the random errors
+    """
+
+    latency: float = 0.2
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 100
+    error_rate: float = 0.0
+    error_status: int = 429
+    embedding_dim: int = 64
+    seed: int = 0
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def answer_tokens(n: int) -> List[str]:
+    return [WORDS[i % len(WORDS)] + " " for i in range(n)]
+
+
+def embed(text: str, dim: int) -> List[float]:
+    # deterministic unit vector derived from the text
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    values = [(digest[i % len(digest)] ^ (i * 31 % 256)) / 255 - 0.5 for i in range(dim)]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+
+def _openai_prompt_tokens(body: Dict[str, Any]) -> int:
+    return sum(count_tokens(str(m.get("content", ""))) for m in body.get("messages", []))
+
+
+def _gemini_prompt_tokens(body: Dict[str, Any]) -> int:
+    texts = [
+        part.get("text", "")
+        for content in body.get("contents", [])
+        for part in content.get("parts", [])
+    ]
+    return sum(count_tokens(t) for t in texts)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    settings: FakeSettings = FakeSettings()
+    random = random.Random(0)
+    lock = threading.Lock()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(
+        self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None
+    ):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_events(self, events: Iterator[Dict[str, Any]], done: bool, separator: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data: str):
+            chunk = f"data: {data}{separator}".encode("utf-8")
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+
+        for event in events:
+            write(json.dumps(event))
+        if done:
+            write("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _fail(self) -> bool:
+        settings = self.settings
+        with self.lock:
+            failing = self.random.random() < settings.error_rate
+        if failing:
+            self._send_json(
+                settings.error_status,
+                {"error": {"code": str(settings.error_status), "message": "fake error"}},
+                {"retry-after": "0"} if settings.error_status == 429 else {},
+            )
+        return failing
+
+    def _tokens(self) -> Iterator[str]:
+        delay = 1 / self.settings.tokens_per_second if self.settings.tokens_per_second else 0
+        for token in answer_tokens(self.settings.answer_tokens):
+            if delay:
+                time.sleep(delay)
+            yield token
+
+    def do_POST(self):
+        body = self._read_json()
+        path = self.path.split("?")[0]
+        time.sleep(self.settings.latency)
+        if self._fail():
+            return
+
+        deployment = re.match(r"/openai/deployments/([^/]+)/(chat/completions|embeddings)$", path)
+        gemini = re.match(r"/v1beta/models/([^:]+):(generateContent|streamGenerateContent)$", path)
+        if deployment and deployment.group(2) == "embeddings":
+            self._embeddings(body, deployment.group(1))
+        elif deployment:
+            self._chat_completion(body, deployment.group(1))
+        elif gemini:
+            self._gemini(body, gemini.group(1), gemini.group(2) == "streamGenerateContent")
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {path}"}})
+
+    def _usage(self, prompt_tokens: int) -> Tuple[int, int, int]:
+        completion = self.settings.answer_tokens
+        return prompt_tokens, completion, prompt_tokens + completion
+
+    def _chat_completion(self, body: Dict[str, Any], deployment: str):
+        prompt, completion, total = self._usage(_openai_prompt_tokens(body))
+        usage = {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": total}
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": deployment}
+
+        if not body.get("stream"):
+            content = "".join(self._tokens())
+            self._send_json(
+                200,
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        def events():
+            for token in self._tokens():
+                yield {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [
+                        {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                    ],
+                }
+            yield {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+
+        self._send_events(events(), done=True, separator="\n\n")
+
+    def _embeddings(self, body: Dict[str, Any], deployment: str):
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        data = []
+        for i, text in enumerate(texts):
+            vector = embed(str(text), self.settings.embedding_dim)
+            if body.get("encoding_format") == "base64":
+                packed = struct.pack(f"<{len(vector)}f", *vector)
+                vector = base64.b64encode(packed).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(count_tokens(str(t)) for t in texts)
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": deployment,
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+        )
+
+    def _gemini(self, body: Dict[str, Any], model: str, stream: bool):
+        prompt, completion, total = self._usage(_gemini_prompt_tokens(body))
+        usage = {
+            "promptTokenCount": prompt,
+            "candidatesTokenCount": completion,
+            "totalTokenCount": total,
+        }
+
+        def candidate(text: str, finished: bool) -> Dict[str, Any]:
+            result = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+            if finished:
+                result["finishReason"] = "STOP"
+            return result
+
+        if not stream:
+            content = "".join(self._tokens())
+            self._send_json(
+                200,
+                {
+                    "candidates": [candidate(content, True)],
+                    "usageMetadata": usage,
+                    "modelVersion": model,
+                },
+            )
+            return
+
+        def events():
+            tokens = list(self._tokens())
+            for i, token in enumerate(tokens):
+                last = i == len(tokens) - 1
+                event = {"candidates": [candidate(token, last)], "modelVersion": model}
+                if last:
+                    event["usageMetadata"] = usage
+                yield event
+
+        self._send_events(events(), done=False, separator="\r\n\r\n")
+
+
+def start_fake_server(settings: FakeSettings, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the fake endpoints in a daemon thread.
+
+    Args:
+        settings: Behaviour of the endpoints
+        port: Port to listen on, 0 for a free one
+
+    Returns:
+        The running server; its port is server.server_address[1]
+    """
+    handler = type(
+        "Handler", (FakeHandler,), {"settings": settings, "random": random.Random(settings.seed)}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=FakeSettings.latency)
+    parser.add_argument("--tokens-per-second", type=float, default=FakeSettings.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=FakeSettings.answer_tokens)
+    parser.add_argument("--error-rate", type=float, default=FakeSettings.error_rate)
+    parser.add_argument("--error-status", type=int, default=FakeSettings.error_status)
+    args = parser.parse_args()
+
+    settings = FakeSettings(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    server = start_fake_server(settings, args.port)
+    print(f"Fake endpoints on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+class FileCache:
+    """
+    Size-bounded LRU cache persisted in a SQLite file.
+
+    The cache can be shared by several processes; SQLite takes care of the
+    locking. Values are pickled, so anything picklable can be stored.
+
+    Attributes:
+        path: Path of the SQLite file
+        max_bytes: Maximum total size of the stored values
+        ttl: Optional time to live of an entry in seconds
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: Optional[float] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+                """
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS accessed ON cache (accessed)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread, sqlite connections can't be shared
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return the value stored under key, or None if missing or expired.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            The cached value or None
+        """
+        now = time.time()
+        with self._connection() as con:
+            row = con.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                con.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+
+            con.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+
+        return pickle.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Store a value and evict the least recently used entries above max_bytes.
+
+        Args:
+            key: Cache key
+            value: Value to store
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+
+        now = time.time()
+        with self._connection() as con:
+            con.execute(
+                "REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+            self._evict(con)
+
+    def delete(self, key: str) -> None:
+        with self._connection() as con:
+            con.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self, con: sqlite3.Connection) -> None:
+        (total,) = con.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        evict = []
+        for key, size in con.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            evict.append((key,))
+            total -= size
+        con.executemany("DELETE FROM cache WHERE key = ?", evict)
@@ -0,0 +1,119 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tokens import count_message_tokens, count_tokens, trim_history
+
+# summarize(previous_summary, messages, model) returns the new summary
+Summarize = Callable[[Optional[str], List[dict], str], str]
+
+
+def summary_message(summary: str) -> dict:
+    return {
+        "role": "user",
+        "content": f"Summary of the earlier conversation:\n{summary}",
+    }
+
+
+class HistoryManager:
+    """
+    Keeps the most recent messages verbatim under a token budget and folds
+    older messages into a rolling summary.
+
+    Summaries are remembered by a hash chain over the folded messages, so
+    when more messages are folded the previous summary is extended with
+    only the new ones instead of summarizing from scratch. Messages are
+    folded in batches so the summary, and with it the prompt prefix,
+    changes only every few turns.
+
+    Attributes:
+        summarize: Function extending a summary with messages, None disables summaries
+        summary_max_tokens: Tokens reserved for the summary
+        fold_batch: Number of messages folded at a time
+        max_summaries: Number of summaries remembered
+    """
+
+    def __init__(
+        self,
+        summarize: Optional[Summarize],
+        summary_max_tokens: int = 500,
+        fold_batch: int = 4,
+        max_summaries: int = 1000,
+    ):
+        self.summarize = summarize
+        self.summary_max_tokens = summary_max_tokens
+        self.fold_batch = fold_batch
+        self.max_summaries = max_summaries
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chain(model: str, messages: List[dict]) -> List[str]:
+        # hashes[i] identifies messages[:i]
+        hashes = [hashlib.sha256(model.encode("utf-8")).hexdigest()]
+        for message in messages:
+            h = hashlib.sha256(hashes[-1].encode("utf-8"))
+            h.update(f"{message['role']}\0{message['content']}".encode("utf-8"))
+            hashes.append(h.hexdigest())
+        return hashes
+
+    def _remember(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    def _summary(self, folded: List[dict], model: str) -> Optional[str]:
+        hashes = self._chain(model, folded)
+
+        # extend the longest prefix that was summarized before
+        start, summary = 0, None
+        with self._lock:
+            for i in range(len(folded), 0, -1):
+                if hashes[i] in self._summaries:
+                    start, summary = i, self._summaries[hashes[i]]
+                    break
+        if start == len(folded):
+            return summary
+
+        summary = self.summarize(summary, folded[start:], model)
+        self._remember(hashes[-1], summary)
+        return summary
+
+    def compact(
+        self, history: List[dict], budget: int, model: str
+    ) -> Tuple[List[dict], Dict[str, Any]]:
+        """
+        Fit the history into a token budget.
+
+        Args:
+            history: Conversation history
+            budget: Maximum number of tokens of the history sent
+            model: Name of the model in model_config
+
+        Returns:
+            Tuple of the history to send, starting with the summary if
+            messages were folded, and a report
+        """
+        report = {"summarized_messages": 0, "summary_tokens": 0}
+        if count_message_tokens(history, model) <= budget:
+            return history, report
+        if self.summarize is None:
+            return trim_history(history, budget, model), report
+
+        recent = trim_history(history, budget - self.summary_max_tokens, model)
+        n_folded = len(history) - len(recent)
+        n_folded = min(-(-n_folded // self.fold_batch) * self.fold_batch, len(history))
+        folded, recent = history[:n_folded], history[n_folded:]
+
+        try:
+            summary = self._summary(folded, model)
+        except Exception as e:
+            print(f"History summary failed: {e}")
+            return recent, report
+
+        report["summarized_messages"] = n_folded
+        report["summary_tokens"] = count_tokens(summary, model)
+        return [summary_message(summary)] + recent, report
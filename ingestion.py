@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+# ingest(file_path, embed, cancelled) parses the file, and embeds it if embed is set;
+# it should return early once cancelled is set
+Ingest = Callable[[str, bool, threading.Event], None]
+
+
+class _Job:
+    def __init__(self, future: Future, embed: bool, cancelled: threading.Event):
+        self.future = future
+        self.embed = embed
+        self.cancelled = cancelled
+
+
+class Ingestor:
+    """
+    Ingests uploaded files in the background so the first message after
+    an upload finds them parsed, and embedded, already.
+
+    Files are reference counted across sessions, since identical uploads
+    share a path; a job is cancelled once no session holds its file. A
+    job that is already running finishes its current step and skips the
+    rest.
+
+    Attributes:
+        ingest: Function ingesting one file
+        max_workers: Number of files ingested at the same time
+    """
+
+    def __init__(self, ingest: Ingest, max_workers: int = 4):
+        self.ingest = ingest
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._jobs: Dict[str, _Job] = {}
+        self._refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def update(
+        self, previous: Optional[List[str]], current: Optional[List[str]], embed: bool = False
+    ) -> List[Future]:
+        """
+        Start ingesting the files of a session and release the removed ones.
+
+        Args:
+            previous: Files of the session before the change
+            current: Files of the session after the change
+            embed: Whether the files are embedded as well
+
+        Returns:
+            The futures of the current files, in order
+        """
+        previous, current = previous or [], current or []
+        with self._lock:
+            for path in set(current) - set(previous):
+                self._refs[path] = self._refs.get(path, 0) + 1
+            for path in set(previous) - set(current):
+                self._refs[path] = self._refs.get(path, 1) - 1
+                if self._refs[path] <= 0:
+                    del self._refs[path]
+                    job = self._jobs.pop(path, None)
+                    if job is not None:
+                        job.cancelled.set()
+                        job.future.cancel()
+
+            futures = []
+            for path in current:
+                job = self._jobs.get(path)
+                if job is None or job.future.cancelled() or (embed and not job.embed):
+                    cancelled = threading.Event()
+                    future = self._pool.submit(self.ingest, path, embed, cancelled)
+                    job = self._jobs[path] = _Job(future, embed, cancelled)
+                futures.append(job.future)
+            return futures
+
+    def wait(self, files: Optional[List[str]], timeout: Optional[float] = None) -> None:
+        """
+        Wait for the background ingestion of files, if any.
+
+        Errors are not raised here; the caller parses the file again and
+        gets them there.
+
+        Args:
+            files: Files about to be used
+            timeout: Maximum number of seconds to wait per file
+        """
+        with self._lock:
+            jobs = [self._jobs.get(path) for path in files or []]
+        for job in jobs:
+            if job is None or job.future.cancelled():
+                continue
+            try:
+                job.future.result(timeout=timeout)
+            except Exception as e:
+                print(f"Background ingestion failed: {e}")
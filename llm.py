@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, List, Union
-import json
+from functools import cache
+from typing import Any, Callable, Dict, Optional
+import importlib
+import threading
 
-from google import genai
-from openai import AzureOpenAI
-
-from config import model_config, available_models, prio_model_name
+from config import (
+    dispatch_config,
+    http_config,
+    model_config,
+    available_models,
+)
 
 
 @dataclass
@@ -24,49 +28,113 @@ class LLM:
     client: Optional[Any] = None
     model: str = None
 
-    def update_model(self, new_model: str) -> str:
-        """
-        Update the model attribute and client with a new value.
 
-        Args:
-            new_model: The new model to use
+AZURE_OPENAI = "openai.AzureOpenAI"
+
+
+@cache
+def import_client(path: str) -> type:
+    """Import a client class from its dotted path, so SDKs load only when used"""
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
 
-        Returns:
-            The updated model name
-        """
 
-        if new_model not in available_models:
-            raise ValueError(f"Model {new_model} not found in model_config.")
+def client_kwargs(model: str) -> Dict[str, Any]:
+    exclude = ["model", "client", "stream", "system_role", "base_url"]
+    kwargs = {k: v for k, v in model_config[model].items() if k not in exclude}
 
-        self.client = create_client(new_model)
-        return new_model
+    # retries and failover are handled by the dispatch layer
+    timeout = dispatch_config["timeout"].get(model)
+    if model_config[model]["client"] == AZURE_OPENAI:
+        kwargs.update(timeout=timeout, max_retries=0)
+    else:
+        http_options = {}
+        if timeout:
+            http_options["timeout"] = int(timeout * 1000)
+        if model_config[model].get("base_url"):
+            http_options["base_url"] = model_config[model]["base_url"]
+        if http_options:
+            kwargs["http_options"] = http_options
+    return kwargs
 
 
-def create_client(model: str) -> Union[AzureOpenAI, genai.Client]:
+def create_client(model: str) -> Any:
 
-    exclude = ["model", "client"]
-    client_cls = model_config[model]["client"]
+    client_cls = import_client(model_config[model]["client"])
 
-    return client_cls(
-        **{k: v for k, v in model_config[model].items() if k not in exclude}
-    )
+    return client_cls(**client_kwargs(model))
 
 
-def get_ai_client() -> LLM:
+def create_async_client(model: str) -> Any:
     """
-    Check available API keys and return the appropriate client.
+    Create an asyncio client for a model.
+
+    OpenAI clients get their own keep-alive connection pool; Gemini clients
+    use the async interface of the SDK client.
+
+    Args:
+        model: Name of the model in model_config
 
     Returns:
-        LLMClient object containing the client type and client object
+        The async client
+    """
+    if model_config[model]["client"] == AZURE_OPENAI:
+        import httpx
+        from openai import AsyncAzureOpenAI
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=http_config["max_connections"],
+                max_keepalive_connections=http_config["max_keepalive_connections"],
+                keepalive_expiry=http_config["keepalive_expiry"],
+            ),
+        )
+        return AsyncAzureOpenAI(**client_kwargs(model), http_client=http_client)
+
+    client_cls = import_client(model_config[model]["client"])
+    return client_cls(**client_kwargs(model)).aio
+
+
+class ClientRegistry:
+    """
+    Registry of LLM clients, built on first use and cached per model.
+
+    Requests look their client up by the model of their session, so
+    sessions on different models never share or swap a client.
     """
 
-    model = prio_model_name
-    client = create_client(model)
+    def __init__(self):
+        self._clients: Dict[str, LLM] = {}
+        self._async_clients: Dict[str, LLM] = {}
+        self._lock = threading.Lock()
+
+    def _get(
+        self, clients: Dict[str, LLM], model: str, factory: Callable[[str], Any]
+    ) -> LLM:
+        llm = clients.get(model)
+        if llm is None:
+            if model not in available_models:
+                raise ValueError(f"Model {model} not found in model_config.")
+            with self._lock:
+                # another thread may have built it while we waited
+                llm = clients.get(model)
+                if llm is None:
+                    llm = clients[model] = LLM(client=factory(model), model=model)
+        return llm
+
+    def get(self, model: str) -> LLM:
+        return self._get(self._clients, model, create_client)
+
+    def get_async(self, model: str) -> LLM:
+        return self._get(self._async_clients, model, create_async_client)
+
+
+client_registry = ClientRegistry()
+
 
-    return LLM(
-        client=client,
-        model=model,
-    )
+def get_client(model: str) -> LLM:
+    return client_registry.get(model)
 
 
-llm_client = get_ai_client()
+def get_async_client(model: str) -> LLM:
+    return client_registry.get_async(model)
@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
+import threading
+import time
 
-
-from chat import chat_wrapper
+from chat import chat_wrapper_async, ingest_wrapper, warmup
+from config import http_config, telemetry_config, warmup_config
+from telemetry import metrics, start_metrics_server
 from ui import create_ui
 
-# Create the UI
-demo = create_ui(chat_wrapper)
 
-# Launch the application
-demo.launch(debug=True, show_error=True)
+def warmup_when_listening():
+    # requests are already served while the warmup runs
+    while not getattr(demo, "is_running", False):
+        time.sleep(0.1)
+    warmup()
+
+
+# the process pool's forkserver imports this module too, it must not start a server
+if __name__ == "__main__":
+    # Create the UI
+    demo = create_ui(chat_wrapper_async, ingest_wrapper)
+
+    # Serve concurrent sessions from the event loop instead of one at a time
+    demo.queue(default_concurrency_limit=http_config["concurrency_limit"])
+
+    if telemetry_config["metrics_port"]:
+        start_metrics_server(telemetry_config["metrics_port"], metrics)
+
+    if warmup_config["enabled"]:
+        threading.Thread(target=warmup_when_listening, daemon=True).start()
+
+    # Launch the application
+    demo.launch(debug=True, show_error=True)
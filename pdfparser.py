@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 
+import codecs
+import hashlib
+import mmap
+import multiprocessing
 import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from config import pdf_size_token_limit
-from functools import cache
-from typing import Any, BinaryIO, Dict, List, Optional, Tuple
-from config import vector_db_config
+from functools import cache, lru_cache, partial
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from chunker import chunk_spans
+from config import cache_config, ingestion_config
+from filecache import FileCache
+from singleflight import SingleFlight
+from telemetry import tracer
+from tokens import count_tokens
 
 import pypdf
 
+# bump whenever the extraction output changes to invalidate the parse cache
+PARSER_VERSION = "5"
+
+parse_cache = FileCache(
+    os.path.join(cache_config["path"], "parse_cache.sqlite"),
+    max_bytes=cache_config["parse_cache_max_bytes"],
+)
+
+# concurrent parses of the same content wait for the one in flight
+parse_flight = SingleFlight()
+
 
 @dataclass
 class Document:
@@ -16,113 +36,422 @@ class Document:
     page: int
     text: str
     id: str
+    # character offsets of the text within its page (PDF) or file (TXT)
+    start: int = 0
+    end: int = 0
+
+
+def chunk_id(document: str, page: int, start: int, text: str) -> str:
+    """Return an id derived from the chunk's content and position"""
+    digest = hashlib.sha256(f"{page}:{start}:{text}".encode("utf-8")).hexdigest()
+    return f"{document}_p{page}_{digest[:16]}"
 
 
-def cache_result(func):
+def file_digest(file_path: str) -> str:
+    """Return the sha256 hex digest of a file's content"""
+    stat = os.stat(file_path)
+    return _file_digest(file_path, stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=1024)
+def _file_digest(file_path: str, size: int, mtime_ns: int) -> str:
+    # size and modification time invalidate the memoized digest of edited files
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_by_content(func):
     """
-    A decorator that caches the results of a function call.
+    A decorator that caches the result of a function of a file path on disk.
+
+    The key is derived from the file content and name and PARSER_VERSION
+    rather than the path, so re-uploaded copies hit the cache and edited
+    files miss it. Keyword arguments only control how the result is
+    computed and are not part of the key. Concurrent calls for the same
+    key share one parse.
 
     Args:
-        func: The function to be decorated
+        func: The function to be decorated, taking the file path first
 
     Returns:
         A wrapper function that caches results
     """
-    cache = {}
 
-    def wrapper(*args, **kwargs):
-        # Create a hashable key from the arguments
-        key = str(args) + str(sorted(kwargs.items()))
+    def wrapper(file_path: str, *args, **kwargs):
+        key = ":".join(
+            [
+                func.__name__,
+                PARSER_VERSION,
+                file_digest(file_path),
+                os.path.basename(file_path),
+                str(args),
+            ]
+        )
 
-        # Return cached result if available
-        if key in cache:
-            return cache[key]
+        def parse():
+            # a parse that just finished may have stored it
+            result = parse_cache.get(key)
+            if result is None:
+                result = func(file_path, *args, **kwargs)
+                parse_cache.set(key, result)
+            return result
 
-        # Calculate result and store in cache
-        result = func(*args, **kwargs)
-        cache[key] = result
+        with tracer.span(
+            func.__name__,
+            file=os.path.basename(file_path),
+            bytes=os.path.getsize(file_path),
+        ) as span:
+            result = parse_cache.get(key)
+            span.set(cache="hit" if result is not None else None)
+            if result is None:
+                result = parse_flight.do(key, parse)
+            span.set(chunks=len(result))
         return result
 
     return wrapper
 
 
-@cache_result
-def extract_pdf_text_by_page(filename: str) -> List[Document]:
-    """Extract text from a single PDF file and return as page chunks
+def iter_pdf_pages(
+    filename: str, start: int = 0, stop: Optional[int] = None
+) -> Iterator[Document]:
+    """Extract text from a single PDF file and yield it in chunks, page by page
 
     :param filename: Path to PDF file
-    :return: List of Document objects with metadata
+    :param start: Index of the first page to extract
+    :param stop: Index after the last page to extract, defaults to the last page
+    :return: Iterator of Document objects with page and offset metadata
     """
     if not (os.path.exists(filename) and filename.lower().endswith(".pdf")):
-        return []
+        return
 
     with open(filename, "rb") as f:
         reader = pypdf.PdfReader(f)
         base_name = os.path.basename(filename)
+        stop = len(reader.pages) if stop is None else min(stop, len(reader.pages))
+
+        for i in range(start, stop):
+            text = reader.pages[i].extract_text()
+            for chunk_start, chunk_end in chunk_spans(text):
+                chunk = text[chunk_start:chunk_end]
+                yield Document(
+                    document=base_name,
+                    page=i + 1,
+                    text=chunk,
+                    id=chunk_id(base_name, i + 1, chunk_start, chunk),
+                    start=chunk_start,
+                    end=chunk_end,
+                )
+
+
+def extract_pdf_text_by_page(
+    filename: str, start: int = 0, stop: Optional[int] = None
+) -> List[Document]:
+    """Extract text from a single PDF file and return as chunks
+
+    :param filename: Path to PDF file
+    :param start: Index of the first page to extract
+    :param stop: Index after the last page to extract, defaults to the last page
+    :return: List of Document objects with metadata
+    """
+    return list(iter_pdf_pages(filename, start, stop))
 
-        return [
-            Document(
-                document=base_name,
-                page=i + 1,
-                text=page.extract_text(),
-                id=f"{base_name}_page_{i+1}",
-            )
-            for i, page in enumerate(reader.pages)
-            if page.extract_text().strip()
-        ]
 
+def count_pdf_pages(filename: str) -> int:
+    if not (os.path.exists(filename) and filename.lower().endswith(".pdf")):
+        return 0
+
+    with open(filename, "rb") as f:
+        return len(pypdf.PdfReader(f).pages)
+
+
+@cache
+def get_executor() -> ProcessPoolExecutor:
+    """Return the process pool shared by all parallel extractions"""
+    # workers are started on demand from a threaded server; a forked worker
+    # could inherit a lock held by another thread, e.g. of the token counts,
+    # and hang, so they are started from a clean process instead
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(
+        max_workers=ingestion_config["max_workers"],
+        mp_context=multiprocessing.get_context(method),
+    )
 
-def extract_chunks_from_txt(
-    file_path, chunk_size=vector_db_config["chunk_size"]
+
+def extract_pdf_text_parallel(
+    filename: str,
+    executor: Executor,
+    pages_per_task: int = ingestion_config["pages_per_task"],
 ) -> List[Document]:
+    """Extract text from a single PDF file, splitting its pages over an executor
+
+    :param filename: Path to PDF file
+    :param executor: Executor the page ranges are submitted to
+    :param pages_per_task: Number of pages extracted by one task
+    :return: List of Document objects in page order
+    """
+    n_pages = count_pdf_pages(filename)
+    futures = [
+        executor.submit(extract_pdf_text_by_page, filename, start, start + pages_per_task)
+        for start in range(0, n_pages, pages_per_task)
+    ]
+    return [document for future in futures for document in future.result()]
+
+
+def iter_txt_chunks(file_path) -> Iterator[Document]:
+    """Read a text file through a memory map and yield it in chunks
+
+    :param file_path: Path to text file
+    :return: Iterator of Document objects, page is the line the chunk starts on
+        and the offsets are character offsets in the file
+    """
     base_name = os.path.basename(file_path)
-    with open(file_path, "r", encoding="utf-8") as f:
-        text = f.read()
-    chunks = [
-        Document(
+    if os.path.getsize(file_path) == 0:
+        return
+
+    def document(buffer_start: int, line: int, start: int, end: int) -> Document:
+        text = buffer[start:end]
+        line += buffer.count("\n", 0, start)
+        return Document(
             document=base_name,
-            page=i,
-            text=text[i : i + chunk_size],
-            id=f"{base_name}_page_{i+1}",
+            page=line,
+            text=text,
+            id=chunk_id(base_name, line, buffer_start + start, text),
+            start=buffer_start + start,
+            end=buffer_start + end,
         )
-        for i in range(0, len(text), chunk_size)
-    ]
-    return chunks
 
+    block_size = 1 << 20
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer_start = 0
+    line = 1
+    buffer = ""
+    with open(file_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as m:
+        for pos in range(0, len(m), block_size):
+            final = pos + block_size >= len(m)
+            buffer += decoder.decode(m[pos : pos + block_size], final=final)
+            spans = chunk_spans(buffer)
+
+            # the last chunk may continue in the next block, chunk it again then
+            for start, end in spans if final else spans[:-1]:
+                yield document(buffer_start, line, start, end)
+
+            if not final and spans:
+                cut = spans[-1][0]
+                line += buffer.count("\n", 0, cut)
+                buffer_start += cut
+                buffer = buffer[cut:]
+
+
+def extract_chunks_from_txt(file_path) -> List[Document]:
+    return list(iter_txt_chunks(file_path))
 
-@cache_result
-def process_file(file_path: str) -> List[Document]:
+
+def iter_file_documents(file_path: str) -> Iterator[Document]:
+    """Yield the documents of a PDF or TXT file without holding the whole file"""
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext == ".pdf":
+        return iter_pdf_pages(file_path)
+    elif ext == ".txt":
+        return iter_txt_chunks(file_path)
+    else:
+        raise ValueError("Unsupported file type. Please provide a PDF or TXT file.")
+
+
+@cache_by_content
+def process_file(file_path: str, executor: Optional[Executor] = None) -> List[Document]:
     ext = os.path.splitext(file_path)[-1].lower()
     if ext == ".pdf":
         print("Processing PDF file...")
-        documents = extract_pdf_text_by_page(file_path)
+        if executor:
+            documents = extract_pdf_text_parallel(file_path, executor)
+        else:
+            documents = extract_pdf_text_by_page(file_path)
     elif ext == ".txt":
         print("Processing TXT file...")
-        documents = extract_chunks_from_txt(
-            file_path, chunk_size=vector_db_config["chunk_size"]
-        )
+        documents = extract_chunks_from_txt(file_path)
     else:
         raise ValueError("Unsupported file type. Please provide a PDF or TXT file.")
 
     return documents
 
 
+def process_files(
+    files: List[str], executor: Optional[Executor] = None
+) -> List[List[Document]]:
+    """Process several files at once, extracting their pages on a process pool
+
+    :param files: Paths of the files
+    :param executor: Executor for the page extraction, defaults to the shared process pool
+    :return: List of Document lists, in the order of files
+    """
+    executor = executor or get_executor()
+    with ThreadPoolExecutor(max_workers=len(files) or 1) as threads:
+        return list(threads.map(partial(process_file, executor=executor), files))
+
+
+def same_span(previous: Document, document: Document) -> bool:
+    """Return whether the offsets of two chunks are comparable"""
+    if previous.document != document.document:
+        return False
+    # PDF offsets start over on every page, TXT offsets run through the file
+    return previous.page == document.page or not document.document.lower().endswith(".pdf")
+
+
+def new_text(previous: Optional[Document], document: Document) -> Optional[str]:
+    """Return the text of a chunk past its overlap with the previous one, None without overlap"""
+    if (
+        previous is not None
+        and same_span(previous, document)
+        and previous.start < document.start <= previous.end
+    ):
+        return document.text[previous.end - document.start :]
+    return None
+
+
 def extract_text(documents: List[Document]) -> str:
-    return "\n".join(document.text for document in documents)
+    """Join the text of chunks, dropping the overlap between consecutive chunks"""
+    texts = []
+    previous = None
+    for document in documents:
+        continuation = new_text(previous, document)
+        if continuation is not None:
+            texts[-1] += continuation
+        else:
+            texts.append(document.text)
+        previous = document
+    return "\n".join(texts)
+
+
+def stream_threshold(token_budget: int) -> int:
+    """
+    Return the size above which a file is streamed into a context of token_budget.
+
+    Such a file is cut to the budget anyway, so parsing all of it into the
+    parse cache first would only make memory grow with the file size.
+    """
+    return min(
+        ingestion_config["stream_threshold_bytes"],
+        token_budget * ingestion_config["stream_bytes_per_token"],
+    )
+
+
+def build_context(
+    files: List[str], token_budget: int, model: str
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """
+    Build a context from the files that fits a token budget.
+
+    The budget is shared across the files so that short files are sent in
+    full and their unused share goes to the longer ones. Files are cut on
+    chunk boundaries. Files larger than the budget can take (see
+    stream_threshold) are read page by page and only until their share is
+    filled, so memory is bounded by the budget rather than the file size.
+    The result is cached by the content of the files, budget and model.
+
+    Args:
+        files: List of uploaded files
+        token_budget: Maximum number of tokens of file text
+        model: Model whose tokenizer is used for counting
+
+    Returns:
+        Tuple of the context string, or None if no files are given, and a
+        budget report
+    """
+    report = {"context_budget": token_budget, "context_tokens": 0, "files": {}}
+    if not files:
+        return None, report
+
+    with tracer.span(
+        "build_context",
+        model=model,
+        files=len(files),
+        bytes=sum(os.path.getsize(f) for f in files),
+    ) as span:
+        context, report = _build_context(files, token_budget, model, report, span)
+        span.set(context_tokens=report["context_tokens"])
+    return context, report
+
+
+def _build_context(
+    files: List[str], token_budget: int, model: str, report: Dict[str, Any], span
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    key = ":".join(
+        ["context", PARSER_VERSION, model, str(token_budget)]
+        + [f"{file_digest(f)}:{os.path.basename(f)}" for f in files]
+    )
+    cached = parse_cache.get(key)
+    span.set(cache="hit" if cached is not None else None)
+    if cached is not None:
+        return cached
+
+    threshold = stream_threshold(token_budget)
+    small = [f for f in files if os.path.getsize(f) <= threshold]
+    parsed = dict(zip(small, process_files(small)))
+    streams = [iter(parsed[f]) if f in parsed else iter_file_documents(f) for f in files]
+
+    kept: List[List[Document]] = [[] for _ in files]
+    used = [0] * len(files)
+    pending: List[Optional[Tuple[Document, int]]] = [None] * len(files)
+    exhausted = [False] * len(files)
+
+    def take(i: int, limit: int):
+        # take whole chunks of file i while its total stays within limit
+        while True:
+            if pending[i] is None:
+                document = next(streams[i], None)
+                if document is None:
+                    exhausted[i] = True
+                    return
+                # only the part not shared with the previous chunk is sent
+                previous = kept[i][-1] if kept[i] else None
+                continuation = new_text(previous, document)
+                text = document.text if continuation is None else continuation
+                pending[i] = (document, count_tokens(text, model))
+            document, tokens = pending[i]
+            if used[i] + tokens > limit:
+                return
+            kept[i].append(document)
+            used[i] += tokens
+            pending[i] = None
+
+    try:
+        # first pass shares what earlier files left over among the later ones
+        remaining = token_budget
+        for i in range(len(files)):
+            take(i, remaining // (len(files) - i))
+            remaining -= used[i]
+
+        # second pass hands the rest to the files that were cut
+        for i in range(len(files)):
+            if not exhausted[i]:
+                take(i, used[i] + token_budget - sum(used))
+    finally:
+        for stream in streams:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    texts = []
+    for f, docs, u, done in zip(files, kept, used, exhausted):
+        texts.append(extract_text(docs))
+        report["files"][os.path.basename(f)] = {
+            "used_tokens": u,
+            "chunks": len(docs),
+            "complete": done,
+        }
+    report["context_tokens"] = sum(used)
 
+    pdf_text = "\n".join(texts)
 
-def create_context(files: List[str]) -> str:
-    context = None
-    if files and len(files) > 0:
-        texts = []
-        text_per_file = round(pdf_size_token_limit / len(files))
-        for f in files:
-            f_doc = process_file(f)
-            f_text = extract_text(f_doc)
-            f_text = f_text[:text_per_file]
-            texts.append(f_text)
+    context = f"Use this information to answer questions:\n{pdf_text}"
+    parse_cache.set(key, (context, report))
+    return context, report
 
-        pdf_text = "\n".join(texts)
 
-        context = f"Use this information to answer questions:\n{pdf_text}"
+def create_context(files: List[str], token_budget: int, model: str) -> Optional[str]:
+    context, _ = build_context(files, token_budget, model)
     return context
@@ -1,22 +1,37 @@
 #!/usr/bin/env python3
 
 """
+Let the LLM calculate bond scenarios in Python, explain and chart them.
+
 - have initial prompt
 - then formulate python script
-- execute python script
-- check if result is pandas dataframe
-- if so, convert to markdown
-- formulate reply
-- create python code that can plot a chart
+- execute python script, the result is a pandas dataframe
+- formulate reply from the dataframe as markdown
+- create python code that can plot a chart, alongside the reply
 - plot it
 - create html page with full result
+
+The steps run as a DAG: the reply and the chart code only depend on the
+calculation, so they are requested at the same time, and every result is
+cached under a hash of its inputs. Rerunning after editing one prompt
+only recomputes the steps downstream of it.
+
+Usage:
+    python pipeline.py --model gpt-4o --force calculation --open
 """
 
-import markdown
-import webbrowser
+import argparse
 import os
-from chat import chat_response, add_to_history
+import webbrowser
+from typing import List, Optional
 
+import markdown
+
+from chat import add_to_history, chat_response
+from config import cache_config, chat_models, pipeline_config, prio_model_name
+from dag import Pipeline, Step
+from filecache import FileCache
+from sandbox import SandboxError, get_sandbox
 
 message = """
 You are a financial software engineer.
@@ -49,36 +64,6 @@ GUIDELINE:
 - Don't print result
 """
 
-message1 = message + message_rules + message_instruction
-
-
-def code_message_cleaner(code: str):
-    """Various heuristics to clean LLM code response."""
-    return code.replace("```python", "").replace("```", "")
-
-
-result1 = chat_response(message1)
-
-
-def exec_wrapper(code: str):
-    namespace = {}
-    exec(code, namespace)
-    return namespace["result"]
-
-
-result2 = exec_wrapper(code_message_cleaner(result1.content))
-
-
-message2 = f"""
-Result of calculation is:
-
-{result2.to_markdown()}
-
-Formulate an answer. Explain briefly how calculation was made."""
-
-result3 = chat_response(message2, history=add_to_history(message, history=[]))
-
-
 message3 = """
 Compare the scenarios by plotting a chart.
 
@@ -98,73 +83,189 @@ GUIDELINE:
 - The last line of the script calls the function and set plot to variable `result`
 """
 
+colors = ["rgba(255, 0, 0, 0.1)", "rgba(0, 0, 255, 0.1)"]
 
-result4 = chat_response(
-    message3,
-    history=[{"role": "user", "content": m} for m in [message, message2]],
-)
+markdown_extensions = ["tables", "fenced_code", "codehilite"]
 
-plot = exec_wrapper(code_message_cleaner(result4.content))
-plot.savefig("plot.png")
 
+def code_message_cleaner(code: str):
+    """Various heuristics to clean LLM code response."""
+    return code.replace("```python", "").replace("```", "")
 
-colors = ["rgba(255, 0, 0, 0.1)", "rgba(0, 0, 255, 0.1)"]
 
+def exec_wrapper(code: str):
+    """Run generated code in the sandbox and return its `result`, figures as PNG"""
+    return get_sandbox().run(code)
 
-html = markdown.markdown(
-    "\n\n----\n\n".join(
-        [
-            message + message_instruction,
-            result1.content,
-            message2,
-            result3.content,
-            message3,
-            result4.content,
-            "![plot](/Users/phi/Documents/Coding/chat_client_pdf/plot.png)",
-        ]
-    ),
-    extensions=["tables", "fenced_code", "codehilite"],
-)
-
-sections = [
-    message + message_instruction,
-    result1.content + "\n\n" + result2.to_markdown(),
-    message2,
-    result3.content,
-    message3,
-    result4.content
-    + "\n\n![plot](/Users/phi/Documents/Coding/chat_client_pdf/plot.png)",
-]
 
+def write_code(message: str, rules: str, instruction: str, model: str) -> str:
+    return chat_response(message + rules + instruction, model=model).content
 
-def print_last_conv(message: str, result: str):
 
-    colored_html_sections = [
-        f'<div style="background-color: {colors[0]}; padding: 10px; margin-bottom: 10px;">{markdown.markdown(message, extensions=['tables', 'fenced_code', 'codehilite'])}</div>',
-        f'<div style="background-color: {colors[1]}; padding: 10px; margin-bottom: 10px;">{markdown.markdown(result, extensions=['tables', 'fenced_code', 'codehilite'])}</div>',
-    ]
-    html = "\n".join(colored_html_sections)
-    with open("./temp_conv.html", "w") as f:
-        f.write(html)
+def calculate(code: str):
+    return exec_wrapper(code_message_cleaner(code))
 
-    # Open in browser
-    webbrowser.open("file:///Users/phi/Documents/Coding/chat_client_pdf/temp_conv.html")
 
-    return None
+def results_prompt(calculation) -> str:
+    return f"""
+Result of calculation is:
+
+{calculation.to_markdown()}
+
+Formulate an answer. Explain briefly how calculation was made."""
 
 
-print_last_conv("test", "answer")
+def explain(results_prompt: str, message: str, model: str) -> str:
+    history = add_to_history(message, history=[])
+    return chat_response(results_prompt, history=history, model=model).content
+
+
+def write_chart_code(results_prompt: str, message: str, instruction: str, model: str) -> str:
+    history = [{"role": "user", "content": m} for m in [message, results_prompt]]
+    return chat_response(instruction, history=history, model=model).content
+
+
+def plot(chart_code: str) -> bytes:
+    """Run the chart code and return the figure as PNG"""
+    png = exec_wrapper(code_message_cleaner(chart_code))
+    if not isinstance(png, bytes):
+        raise SandboxError(f"The chart code did not return a figure but {png!r:.100}")
+    return png
+
+
+def colored_html(sections: List[str]) -> str:
+    return "\n".join(
+        f'<div style="background-color: {colors[i % 2]}; padding: 10px; margin-bottom: 10px;">'
+        f"{markdown.markdown(section, extensions=markdown_extensions)}</div>"
+        for i, section in enumerate(sections)
+    )
+
+
+def render(
+    output_dir: str,
+    message: str,
+    instruction: str,
+    chart_instruction: str,
+    code: str,
+    calculation,
+    results_prompt: str,
+    explain: str,
+    chart_code: str,
+    plot: bytes,
+) -> str:
+    """Write the conversation as HTML next to the chart and return its path"""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "plot.png"), "wb") as f:
+        f.write(plot)
+
+    sections = [
+        message + instruction,
+        code + "\n\n" + calculation.to_markdown(),
+        results_prompt,
+        explain,
+        chart_instruction,
+        chart_code + "\n\n![plot](plot.png)",
+    ]
+    path = os.path.join(output_dir, "conversation.html")
+    with open(path, "w") as f:
+        f.write(colored_html(sections))
+    return path
+
 
+def print_last_conv(message: str, result: str):
+    path = os.path.abspath("./temp_conv.html")
+    with open(path, "w") as f:
+        f.write(colored_html([message, result]))
 
-colored_html_sections = [
-    f'<div style="background-color: {colors[i % 2]}; padding: 10px; margin-bottom: 10px;">{markdown.markdown(section, extensions=['tables', 'fenced_code', 'codehilite'])}</div>'
-    for i, section in enumerate(sections)
-]
-html = "\n".join(colored_html_sections)
+    # Open in browser
+    webbrowser.open(f"file://{path}")
 
+    return None
 
-with open("./conversation.html", "w") as f:
-    f.write(html)
 
-# Open in browser
-# webbrowser.open("file:///Users/phi/Documents/Coding/chat_client_pdf/conversation.html")
+def build_pipeline(
+    model: str = prio_model_name,
+    output_dir: str = ".",
+    cache: Optional[FileCache] = None,
+) -> Pipeline:
+    """
+    Declare the steps of the scenario pipeline.
+
+    Args:
+        model: Name of the chat model in model_config
+        output_dir: Directory the HTML page and the chart are written to
+        cache: Cache of the step results, None to recompute every step
+
+    Returns:
+        The pipeline, run it with pipeline.run()
+    """
+    steps = [
+        Step(
+            "code",
+            write_code,
+            inputs=dict(
+                message=message, rules=message_rules, instruction=message_instruction, model=model
+            ),
+        ),
+        Step("calculation", calculate, depends=["code"]),
+        Step("results_prompt", results_prompt, depends=["calculation"]),
+        Step(
+            "explain",
+            explain,
+            depends=["results_prompt"],
+            inputs=dict(message=message, model=model),
+        ),
+        Step(
+            "chart_code",
+            write_chart_code,
+            depends=["results_prompt"],
+            inputs=dict(message=message, instruction=message3, model=model),
+        ),
+        Step("plot", plot, depends=["chart_code"]),
+        Step(
+            "render",
+            render,
+            depends=["code", "calculation", "results_prompt", "explain", "chart_code", "plot"],
+            inputs=dict(
+                output_dir=output_dir,
+                message=message,
+                instruction=message_instruction,
+                chart_instruction=message3,
+            ),
+            # writes files, so it runs every time
+            cache=False,
+        ),
+    ]
+    return Pipeline(steps, cache=cache, max_workers=pipeline_config["max_workers"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=prio_model_name, choices=chat_models)
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument(
+        "--force", nargs="*", default=[], help="steps to recompute despite the cache"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="don't read or store results")
+    parser.add_argument("--open", action="store_true", help="open the page in a browser")
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        cache = FileCache(
+            os.path.join(cache_config["path"], "pipeline_cache.sqlite"),
+            max_bytes=pipeline_config["cache_max_bytes"],
+        )
+    # start the workers while the code is being written
+    get_sandbox()
+    pipeline = build_pipeline(args.model, args.output_dir, cache)
+    results = pipeline.run(force=args.force)
+
+    path = os.path.abspath(results["render"])
+    print(f"Conversation written to {path}")
+    if args.open:
+        webbrowser.open(f"file://{path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+from config import rate_limit_config
+
+# lower values are served first
+INTERACTIVE, BATCH, EMBEDDING = 0, 1, 2
+
+# priority of the requests made in the current context; chat requests keep
+# the default, the batch runner and bulk embedding lower it
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=INTERACTIVE
+)
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at per_minute / 60 per second up to per_minute.
+
+    The level may go below zero when a request used more than was
+    reserved for it; the debt is paid off by the refill.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # a request larger than the bucket waits for a full bucket
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+
+class _Waiter:
+    def __init__(self, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.tokens = tokens
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+        self.cancelled = False
+
+    def wake(self) -> None:
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_set_result, self.future)
+
+
+def _set_result(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class ModelLimiter:
+    """
+    Requests-per-minute and tokens-per-minute buckets of one deployment
+    with a priority queue in front.
+
+    Waiting requests are admitted in order of priority, then arrival, once
+    both buckets hold enough for them. A request is never overtaken by a
+    lower priority one, so batch and embedding work queue behind chat
+    requests instead of competing with them for quota.
+
+    Attributes:
+        requests: Bucket of requests, None for no limit
+        tokens: Bucket of tokens, None for no limit
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self._queue: List[Any] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def _buckets(self) -> List[TokenBucket]:
+        return [b for b in (self.requests, self.tokens) if b is not None]
+
+    def _grant(self) -> None:
+        # called with the lock held: admit waiters from the head of the queue
+        now = time.monotonic()
+        for bucket in self._buckets():
+            bucket.refill(now)
+
+        while self._queue:
+            waiter = self._queue[0][2]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+
+            delay = self.paused_until - now
+            if self.requests is not None:
+                delay = max(delay, self.requests.wait_time(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.wait_time(waiter.tokens))
+            if delay > 0:
+                self._schedule(delay)
+                return
+
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= waiter.tokens
+            heapq.heappop(self._queue)
+            waiter.wake()
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._grant()
+
+    def _enqueue(self, waiter: _Waiter, priority: Optional[int]) -> None:
+        if priority is None:
+            priority = request_priority.get()
+        with self._lock:
+            heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+            self._grant()
+
+    def acquire(self, tokens: int, priority: Optional[int] = None) -> None:
+        """
+        Block until a request of about tokens tokens may be sent.
+
+        Args:
+            tokens: Estimated tokens of the request
+            priority: Priority of the request, defaults to request_priority
+        """
+        waiter = _Waiter(tokens)
+        self._enqueue(waiter, priority)
+        waiter.event.wait()
+
+    async def acquire_async(self, tokens: int, priority: Optional[int] = None) -> None:
+        """Async variant of acquire that waits without blocking the event loop"""
+        waiter = _Waiter(tokens, asyncio.get_running_loop())
+        self._enqueue(waiter, priority)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiter.cancelled = True
+            raise
+
+    def settle(self, estimated: int, used: Optional[int]) -> None:
+        """Correct the token bucket once the real usage of a request is known, None if unknown"""
+        if self.tokens is None or used is None:
+            return
+        with self._lock:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + estimated - used)
+            self._grant()
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Align the buckets with the x-ratelimit-* headers of a response.
+
+        The provider's remaining quota wins when it is lower than ours, for
+        instance because other clients share the deployment.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                if bucket is None:
+                    continue
+                bucket.refill(now)
+                limit = _header_number(headers, f"x-ratelimit-limit-{name}")
+                if limit:
+                    bucket.capacity = limit
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{name}")
+                if remaining is not None:
+                    bucket.level = min(bucket.level, remaining)
+            self._grant()
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request back for seconds, e.g. after a 429"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self._grant()
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the seconds to wait that a 429 error asks for, if it says"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    return _header_number(headers, "retry-after")
+
+
+class RateLimiter:
+    """
+    Client-side rate limits of all deployments, keyed by model_config entry.
+
+    Models without limits are not throttled; every method is a no-op for
+    them.
+
+    Attributes:
+        limits: {"rpm": ..., "tpm": ...} per model
+        pause_on_429: Seconds to hold a model back after a 429 without Retry-After
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, Optional[int]]], pause_on_429: float = 5.0):
+        self.limits = limits
+        self.pause_on_429 = pause_on_429
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str) -> Optional[ModelLimiter]:
+        limits = self.limits.get(model) or {}
+        if not (limits.get("rpm") or limits.get("tpm")):
+            return None
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = ModelLimiter(limits.get("rpm"), limits.get("tpm"))
+            return self._limiters[model]
+
+    def acquire(self, model: str, tokens: int, priority: Optional[int] = None) -> None:
+        limiter = self.get(model)
+        if limiter is not None:
+            limiter.acquire(tokens, priority)
+
+    async def acquire_async(self, model: str, tokens: int, priority: Optional[int] = None) -> None:
+        limiter = self.get(model)
+        if limiter is not None:
+            await limiter.acquire_async(tokens, priority)
+
+    def settle(self, model: str, estimated: int, used: Optional[int]) -> None:
+        limiter = self.get(model)
+        if limiter is not None:
+            limiter.settle(estimated, used)
+
+    def observe_headers(self, model: str, headers: Mapping[str, str]) -> None:
+        limiter = self.get(model)
+        if limiter is not None:
+            limiter.observe_headers(headers)
+
+    def observe_error(self, model: str, error: Exception) -> None:
+        limiter = self.get(model)
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if limiter is not None and status == 429:
+            limiter.pause(retry_after(error) or self.pause_on_429)
+
+
+rate_limiter = RateLimiter(
+    rate_limit_config["limits"], pause_on_429=rate_limit_config["pause_on_429"]
+)
@@ -1,15 +1,99 @@
-import os
-from typing import Dict, Tuple, List, Any, Optional
+import hashlib
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Iterator, Tuple, List, Optional
 from utilities import extract_token_usage
 from dataclasses import dataclass
 from llm import LLM
-from config import model_config
+from config import gemini_context_cache_config, model_config, system_prompt
+from ratelimit import rate_limiter
+from singleflight import AsyncSingleFlight, SingleFlight
+from tokens import count_message_tokens, count_tokens
+
+if TYPE_CHECKING:
+    # the SDK is imported on first use, see llm.py
+    from google.genai import types
 
 
 @dataclass
 class Response:
     content: str
     token_usage: dict
+    budget: Optional[dict] = None
+    model: Optional[str] = None
+    cache: Optional[str] = None
+
+
+def estimate_prompt_tokens(
+    message: str, history: List[dict], model: str, context: Optional[str] = None
+) -> int:
+    """Estimate the prompt tokens of a request before it is sent, for the rate limiter"""
+    return (
+        count_tokens(system_prompt, model)
+        + count_tokens(context or "", model)
+        + count_message_tokens(history, model)
+        + count_tokens(message, model)
+    )
+
+
+@dataclass
+class Reservation:
+    """
+    Tokens reserved for a request in the rate limiter.
+
+    Attributes:
+        answered: The provider accepted the request and started answering
+        used: Tokens the request used as reported by the provider, None if unknown
+    """
+
+    answered: bool = False
+    used: Optional[int] = None
+
+    def record(self, token_usage: Dict[str, int]) -> None:
+        self.used = token_usage["total_tokens"] or None
+
+
+def _observe_error(model: str, reservation: Reservation, error: Exception) -> None:
+    rate_limiter.observe_error(model, error)
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if not reservation.answered and isinstance(status, int):
+        # the provider rejected the request, so it used none of the quota
+        reservation.used = 0
+
+
+@contextmanager
+def rate_limited(model: str, estimate: int) -> Iterator[Reservation]:
+    """
+    Hold quota for a request while it is sent and its response, or stream, is read.
+
+    Errors, including ones raised while reading a stream, go to the rate
+    limiter, so a 429 backs off the whole model. The reservation is always
+    settled: with the usage the provider reported, refunded when the
+    provider rejected the request, and kept at the estimate otherwise.
+    """
+    rate_limiter.acquire(model, estimate)
+    reservation = Reservation()
+    try:
+        yield reservation
+    except Exception as e:
+        _observe_error(model, reservation, e)
+        raise
+    finally:
+        rate_limiter.settle(model, estimate, reservation.used)
+
+
+@asynccontextmanager
+async def rate_limited_async(model: str, estimate: int) -> AsyncIterator[Reservation]:
+    await rate_limiter.acquire_async(model, estimate)
+    reservation = Reservation()
+    try:
+        yield reservation
+    except Exception as e:
+        _observe_error(model, reservation, e)
+        raise
+    finally:
+        rate_limiter.settle(model, estimate, reservation.used)
 
 
 def handle_openai_request(
@@ -32,34 +116,123 @@ def handle_openai_request(
     Returns:
         Tuple containing the response text and token usage information
     """
+    messages = build_openai_messages(message, history, model, context, last_n)
+    estimate = count_message_tokens(messages, model)
+
+    with rate_limited(model, estimate) as reservation:
+        raw = llm_client.client.chat.completions.with_raw_response.create(
+            model=model_config[model]["model"],
+            messages=messages,
+        )
+        reservation.answered = True
+        rate_limiter.observe_headers(model, raw.headers)
+        response = raw.parse()
+        token_usage = extract_token_usage(response, "azure_openai")
+        reservation.record(token_usage)
+
+    content = response.choices[0].message.content.strip()
+    return Response(content, token_usage)
+
+
+def stream_openai_request(
+    llm_client: LLM,
+    message: str,
+    history: List[Tuple[str, str]],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Iterator[Response]:
+    """
+    Stream a response from an Azure OpenAI client.
+
+    Args:
+        llm_client: The Azure OpenAI client
+        message: The user's message
+        history: Conversation history
+        context: Optional context from PDF files
+
+    Yields:
+        Response with the text received so far; token usage is filled in
+        on the last response of the stream
+    """
+    if not model_config[model].get("stream", True):
+        # model does not support streaming, return the full answer at once
+        yield handle_openai_request(
+            llm_client, message, history, model, context, last_n
+        )
+        return
+
+    messages = build_openai_messages(message, history, model, context, last_n)
+    estimate = count_message_tokens(messages, model)
+
+    # the stream is read inside, so its errors reach the rate limiter too
+    with rate_limited(model, estimate) as reservation:
+        raw = llm_client.client.chat.completions.with_raw_response.create(
+            model=model_config[model]["model"],
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        reservation.answered = True
+        rate_limiter.observe_headers(model, raw.headers)
+        stream = raw.parse()
+
+        content = ""
+        token_usage = extract_token_usage(None, "azure_openai")
+        for chunk in stream:
+            if chunk.usage:
+                token_usage = extract_token_usage(chunk, "azure_openai")
+                reservation.record(token_usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                content += chunk.choices[0].delta.content
+                yield Response(content, token_usage)
+
+    yield Response(content.strip(), token_usage)
+
+
+def build_openai_messages(
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> List[dict]:
+    """
+    Build the message list for a chat completion request.
+
+    The system prompt and the context come first and don't change between
+    turns, so the provider can reuse its cache of the prompt prefix.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        model: Name of the model in model_config
+        context: Optional context from PDF files
+        last_n: Last n messages to include
+
+    Returns:
+        List of messages
+    """
     messages = []
 
+    if model_config[model].get("system_role", True):
+        messages += [{"role": "system", "content": system_prompt}]
+
     # Add context if available
     if context:
         messages += [{"role": "user", "content": context}]
 
-    def _msg_role(x):
-        if x["role"] == "user":
-            m = f"User: {x['content']}\n"
-        elif x["role"] == "assistant":
-            m = f"Assistant: {x['content']}\n\n"
-        return m
+    if not last_n:
+        last_n = len(history)
 
-    messages += [{"role": item["role"], "content": item["content"]} for item in history]
+    messages += [
+        {"role": item["role"], "content": item["content"]} for item in history[-last_n:]
+    ]
 
     # Add current message
     messages += [{"role": "user", "content": message}]
 
-    response = llm_client.client.chat.completions.create(
-        model=model_config[model]["model"],
-        messages=messages,
-    )
-
-    # Extract token usage
-    token_usage = extract_token_usage(response, "azure_openai")
-
-    content = response.choices[0].message.content.strip()
-    return Response(content, token_usage)
+    return messages
 
 
 def handle_gemini_request(
@@ -83,35 +256,494 @@ def handle_gemini_request(
     Returns:
         Tuple containing the response text and token usage information
     """
-    prompt = ""
+    contents, config = build_gemini_request(
+        llm_client, message, history, model, context, last_n
+    )
+
+    estimate = estimate_prompt_tokens(message, history, model, context)
+
+    # Get response from Gemini
+    with rate_limited(model, estimate) as reservation:
+        response = llm_client.client.models.generate_content(
+            model=model_config[model]["model"],
+            contents=contents,
+            config=config,
+        )
+        token_usage = extract_token_usage(response, "gemini")
+        reservation.record(token_usage)
+
+    content = response.text.strip()
+    return Response(content, token_usage)
+
+
+def stream_gemini_request(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Iterator[Response]:
+    """
+    Stream a response from a Gemini client.
+
+    Args:
+        client: The Gemini client
+        message: The user's message
+        history: Conversation history
+        last_n: Last n messages to include
+        context: Optional context from PDF files
+
+    Yields:
+        Response with the text received so far; token usage is filled in
+        on the last response of the stream
+    """
+    contents, config = build_gemini_request(
+        llm_client, message, history, model, context, last_n
+    )
+
+    estimate = estimate_prompt_tokens(message, history, model, context)
+
+    # the stream is read inside, so its errors reach the rate limiter too
+    with rate_limited(model, estimate) as reservation:
+        stream = llm_client.client.models.generate_content_stream(
+            model=model_config[model]["model"],
+            contents=contents,
+            config=config,
+        )
+
+        content = ""
+        token_usage = extract_token_usage(None, "gemini")
+        for chunk in stream:
+            reservation.answered = True
+            if chunk.usage_metadata:
+                token_usage = extract_token_usage(chunk, "gemini")
+                reservation.record(token_usage)
+            if chunk.text:
+                content += chunk.text
+                yield Response(content, token_usage)
+
+    yield Response(content.strip(), token_usage)
+
+
+def build_gemini_contents(
+    message: str,
+    history: List[dict],
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> List["types.Content"]:
+    """
+    Build the contents of a Gemini request.
+
+    The context comes first and doesn't change between turns, followed by
+    the history and the current message, so the prompt prefix can be cached.
+
+    Args:
+        message: The user's message
+        history: Conversation history
+        context: Optional context from PDF files
+        last_n: Last n messages to include
+
+    Returns:
+        List of contents
+    """
+    from google.genai import types
+
+    contents = []
 
     # Add context if available
     if context:
-        prompt += context + "\n\n"
+        contents += [types.Content(role="user", parts=[types.Part(text=context)])]
 
     def _msg_role(x):
-        if x["role"] == "user":
-            m = f"User: {x['content']}\n"
-        elif x["role"] == "assistant":
-            m = f"Assistant: {x['content']}\n\n"
-        return m
+        role = "model" if x["role"] == "assistant" else "user"
+        return types.Content(role=role, parts=[types.Part(text=x["content"])])
 
     if not last_n:
         last_n = len(history)
 
-    prompt += "".join(map(_msg_role, history[-last_n:]))
+    contents += list(map(_msg_role, history[-last_n:]))
 
     # Add current message
-    prompt += f"User: {message}\nAssistant:"
+    contents += [types.Content(role="user", parts=[types.Part(text=message)])]
 
-    # Get response from Gemini
-    response = llm_client.client.models.generate_content(
-        model=model_config[model]["model"],
-        contents=prompt,
+    return contents
+
+
+class GeminiContextCache:
+    """
+    Explicit Gemini context caches of the document context.
+
+    The system prompt and context are uploaded once per model and context
+    and later turns refer to the cache by name, so they are not sent and
+    billed in full again. Sessions on the same documents share the cache;
+    concurrent turns wait for the one upload in flight. A cache about to
+    expire gets its TTL extended rather than being uploaded again.
+    Contexts below min_tokens are not cached, as the API rejects them.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, Tuple[Optional[str], float]] = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+
+    @staticmethod
+    def _key(model: str, context: str) -> str:
+        return f"{model}:{hashlib.sha256(context.encode('utf-8')).hexdigest()}"
+
+    def _lookup(self, key: str) -> Tuple[bool, Optional[str], float]:
+        with self._lock:
+            name, expires = self._caches.get(key, (None, 0))
+        # renew the cache a minute before the provider expires it
+        return time.time() < expires - 60, name, expires
+
+    def _cached(self, model: str, context: Optional[str]) -> bool:
+        if not (gemini_context_cache_config["enabled"] and context):
+            return False
+        return count_tokens(context, model) >= gemini_context_cache_config["min_tokens"]
+
+    def _create_config(self, context: str) -> "types.CreateCachedContentConfig":
+        from google.genai import types
+
+        return types.CreateCachedContentConfig(
+            contents=[types.Content(role="user", parts=[types.Part(text=context)])],
+            system_instruction=system_prompt,
+            ttl=f"{gemini_context_cache_config['ttl']}s",
+        )
+
+    def _update_config(self) -> "types.UpdateCachedContentConfig":
+        from google.genai import types
+
+        return types.UpdateCachedContentConfig(ttl=f"{gemini_context_cache_config['ttl']}s")
+
+    def _store(self, key: str, name: Optional[str]) -> Optional[str]:
+        # failed creations are remembered too, so they aren't retried every turn
+        expires = time.time() + gemini_context_cache_config["ttl"]
+        with self._lock:
+            self._caches[key] = (name, expires)
+        return name
+
+    def _renew(self, llm_client: LLM, model: str, context: str, key: str) -> Optional[str]:
+        # a renewal that just finished may have stored it
+        valid, name, expires = self._lookup(key)
+        if valid:
+            return name
+
+        if name and time.time() < expires:
+            try:
+                llm_client.client.caches.update(name=name, config=self._update_config())
+                return self._store(key, name)
+            except Exception as e:
+                print(f"Gemini context cache not extended, creating a new one: {e}")
+
+        try:
+            cache = llm_client.client.caches.create(
+                model=model_config[model]["model"], config=self._create_config(context)
+            )
+            name = cache.name
+        except Exception as e:
+            print(f"Gemini context cache not created: {e}")
+            name = None
+        return self._store(key, name)
+
+    async def _renew_async(
+        self, llm_client: LLM, model: str, context: str, key: str
+    ) -> Optional[str]:
+        valid, name, expires = self._lookup(key)
+        if valid:
+            return name
+
+        if name and time.time() < expires:
+            try:
+                await llm_client.client.caches.update(name=name, config=self._update_config())
+                return self._store(key, name)
+            except Exception as e:
+                print(f"Gemini context cache not extended, creating a new one: {e}")
+
+        try:
+            cache = await llm_client.client.caches.create(
+                model=model_config[model]["model"], config=self._create_config(context)
+            )
+            name = cache.name
+        except Exception as e:
+            print(f"Gemini context cache not created: {e}")
+            name = None
+        return self._store(key, name)
+
+    def get(self, llm_client: LLM, model: str, context: Optional[str]) -> Optional[str]:
+        """
+        Return the name of the context cache, creating or extending it if needed.
+
+        Args:
+            llm_client: The Gemini client
+            model: Name of the model in model_config
+            context: Context from PDF files
+
+        Returns:
+            Name of the cached content, or None if the context isn't cached
+        """
+        if not self._cached(model, context):
+            return None
+        key = self._key(model, context)
+        valid, name, _ = self._lookup(key)
+        if valid:
+            return name
+        return self._flight.do(key, self._renew, llm_client, model, context, key)
+
+    async def get_async(
+        self, llm_client: LLM, model: str, context: Optional[str]
+    ) -> Optional[str]:
+        """Async variant of get for the asyncio Gemini client"""
+        if not self._cached(model, context):
+            return None
+        key = self._key(model, context)
+        valid, name, _ = self._lookup(key)
+        if valid:
+            return name
+        return await self._async_flight.do(
+            key, self._renew_async, llm_client, model, context, key
+        )
+
+
+gemini_context_cache = GeminiContextCache()
+
+
+def _gemini_request(
+    message: str,
+    history: List[dict],
+    context: Optional[str],
+    last_n: Optional[int],
+    cached_content: Optional[str],
+) -> Tuple[List["types.Content"], "types.GenerateContentConfig"]:
+    from google.genai import types
+
+    if cached_content:
+        # the system prompt and context live in the cache
+        contents = build_gemini_contents(message, history, None, last_n)
+        return contents, types.GenerateContentConfig(cached_content=cached_content)
+
+    contents = build_gemini_contents(message, history, context, last_n)
+    return contents, types.GenerateContentConfig(system_instruction=system_prompt)
+
+
+def build_gemini_request(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Tuple[List["types.Content"], "types.GenerateContentConfig"]:
+    """
+    Build the contents and config of a Gemini request, using the context cache if enabled.
+
+    Args:
+        llm_client: The Gemini client
+        message: The user's message
+        history: Conversation history
+        model: Name of the model in model_config
+        context: Optional context from PDF files
+        last_n: Last n messages to include
+
+    Returns:
+        Tuple of the contents and the request config
+    """
+    cached_content = gemini_context_cache.get(llm_client, model, context)
+    return _gemini_request(message, history, context, last_n, cached_content)
+
+
+async def build_gemini_request_async(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Tuple[List["types.Content"], "types.GenerateContentConfig"]:
+    """Async variant of build_gemini_request for the asyncio Gemini client"""
+    cached_content = await gemini_context_cache.get_async(llm_client, model, context)
+    return _gemini_request(message, history, context, last_n, cached_content)
+
+
+async def handle_openai_request_async(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Response:
+    """
+    Handle requests for Azure OpenAI clients with an asyncio client.
+
+    Args:
+        llm_client: The async Azure OpenAI client
+        message: The user's message
+        history: Conversation history
+        context: Optional context from PDF files
+
+    Returns:
+        Response containing the response text and token usage information
+    """
+    messages = build_openai_messages(message, history, model, context, last_n)
+    estimate = count_message_tokens(messages, model)
+
+    async with rate_limited_async(model, estimate) as reservation:
+        raw = await llm_client.client.chat.completions.with_raw_response.create(
+            model=model_config[model]["model"],
+            messages=messages,
+        )
+        reservation.answered = True
+        rate_limiter.observe_headers(model, raw.headers)
+        response = raw.parse()
+        token_usage = extract_token_usage(response, "azure_openai")
+        reservation.record(token_usage)
+
+    content = response.choices[0].message.content.strip()
+    return Response(content, token_usage)
+
+
+async def stream_openai_request_async(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> AsyncIterator[Response]:
+    """
+    Stream a response from an Azure OpenAI client with an asyncio client.
+
+    Args:
+        llm_client: The async Azure OpenAI client
+        message: The user's message
+        history: Conversation history
+        context: Optional context from PDF files
+
+    Yields:
+        Response with the text received so far; token usage is filled in
+        on the last response of the stream
+    """
+    if not model_config[model].get("stream", True):
+        yield await handle_openai_request_async(
+            llm_client, message, history, model, context, last_n
+        )
+        return
+
+    messages = build_openai_messages(message, history, model, context, last_n)
+    estimate = count_message_tokens(messages, model)
+
+    # the stream is read inside, so its errors reach the rate limiter too
+    async with rate_limited_async(model, estimate) as reservation:
+        raw = await llm_client.client.chat.completions.with_raw_response.create(
+            model=model_config[model]["model"],
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        reservation.answered = True
+        rate_limiter.observe_headers(model, raw.headers)
+        stream = raw.parse()
+
+        content = ""
+        token_usage = extract_token_usage(None, "azure_openai")
+        async for chunk in stream:
+            if chunk.usage:
+                token_usage = extract_token_usage(chunk, "azure_openai")
+                reservation.record(token_usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                content += chunk.choices[0].delta.content
+                yield Response(content, token_usage)
+
+    yield Response(content.strip(), token_usage)
+
+
+async def handle_gemini_request_async(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> Response:
+    """
+    Handle requests for Gemini client with the asyncio interface.
+
+    Args:
+        llm_client: The async Gemini client
+        message: The user's message
+        history: Conversation history
+        last_n: Last n messages to include
+        context: Optional context from PDF files
+
+    Returns:
+        Response containing the response text and token usage information
+    """
+    contents, config = await build_gemini_request_async(
+        llm_client, message, history, model, context, last_n
     )
 
-    # Extract token usage
-    token_usage = extract_token_usage(response, "gemini")
+    estimate = estimate_prompt_tokens(message, history, model, context)
+
+    async with rate_limited_async(model, estimate) as reservation:
+        response = await llm_client.client.models.generate_content(
+            model=model_config[model]["model"],
+            contents=contents,
+            config=config,
+        )
+        token_usage = extract_token_usage(response, "gemini")
+        reservation.record(token_usage)
 
     content = response.text.strip()
     return Response(content, token_usage)
+
+
+async def stream_gemini_request_async(
+    llm_client: LLM,
+    message: str,
+    history: List[dict],
+    model: str,
+    context: Optional[str] = None,
+    last_n: Optional[int] = None,
+) -> AsyncIterator[Response]:
+    """
+    Stream a response from a Gemini client with the asyncio interface.
+
+    Args:
+        llm_client: The async Gemini client
+        message: The user's message
+        history: Conversation history
+        last_n: Last n messages to include
+        context: Optional context from PDF files
+
+    Yields:
+        Response with the text received so far; token usage is filled in
+        on the last response of the stream
+    """
+    contents, config = await build_gemini_request_async(
+        llm_client, message, history, model, context, last_n
+    )
+
+    estimate = estimate_prompt_tokens(message, history, model, context)
+
+    # the stream is read inside, so its errors reach the rate limiter too
+    async with rate_limited_async(model, estimate) as reservation:
+        stream = await llm_client.client.models.generate_content_stream(
+            model=model_config[model]["model"],
+            contents=contents,
+            config=config,
+        )
+
+        content = ""
+        token_usage = extract_token_usage(None, "gemini")
+        async for chunk in stream:
+            reservation.answered = True
+            if chunk.usage_metadata:
+                token_usage = extract_token_usage(chunk, "gemini")
+                reservation.record(token_usage)
+            if chunk.text:
+                content += chunk.text
+                yield Response(content, token_usage)
+
+    yield Response(content.strip(), token_usage)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import re
+import threading
+from dataclasses import replace
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from filecache import FileCache
+from request import Response
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def request_scope(model: str, context: Optional[str], history: List[dict]) -> str:
+    history = [(m["role"], normalize(m["content"])) for m in history]
+    return sha256(json.dumps([model, sha256(context or ""), history]))
+
+
+def request_key(
+    model: str, context: Optional[str], history: List[dict], message: str
+) -> str:
+    """Return the key identifying identical requests"""
+    return f"response:{sha256(request_scope(model, context, history) + normalize(message))}"
+
+
+class ResponseCache:
+    """
+    Cache of chat responses in front of the LLM request.
+
+    The exact tier is keyed by the model, a hash of the context, the
+    normalized history and the normalized message. The optional semantic
+    tier embeds the message and returns the cached answer of the most
+    similar earlier message with the same model, context and history, if
+    its cosine similarity is above the threshold.
+
+    Attributes:
+        store: Persistent store of the responses
+        embedding_function: Embeds messages for the semantic tier, None disables it
+        similarity_threshold: Minimum cosine similarity of a semantic hit
+        max_semantic_entries: Messages kept per model, context and history
+    """
+
+    def __init__(
+        self,
+        store: FileCache,
+        embedding_function: Optional[Callable[[List[str]], Any]] = None,
+        similarity_threshold: float = 0.95,
+        max_semantic_entries: int = 200,
+    ):
+        self.store = store
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.max_semantic_entries = max_semantic_entries
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, model: str, context: Optional[str], history: List[dict], message: str
+    ) -> Optional[Response]:
+        """
+        Look a response up, first exactly and then semantically.
+
+        Args:
+            model: Name of the model
+            context: Context sent with the message
+            history: Conversation history sent with the message
+            message: The user's message
+
+        Returns:
+            The cached response with zero token usage and its cache tier, or None
+        """
+        scope = request_scope(model, context, history)
+        response = self.store.get(request_key(model, context, history, message))
+        tier = "exact"
+
+        if response is None and self.embedding_function is not None:
+            response = self._semantic_get(scope, message)
+            tier = "semantic"
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            elif tier == "exact":
+                self.exact_hits += 1
+            else:
+                self.semantic_hits += 1
+
+        if response is None:
+            return None
+        token_usage = {k: 0 for k in response.token_usage}
+        return replace(response, token_usage=token_usage, cache=tier)
+
+    def _semantic_get(self, scope: str, message: str) -> Optional[Response]:
+        entries = self.store.get(f"semantic:{scope}")
+        if not entries:
+            return None
+
+        query = np.asarray(self.embedding_function([normalize(message)])[0], dtype=np.float32)
+        vectors = np.stack([vector for vector, _ in entries])
+        similarity = vectors @ query / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12
+        )
+
+        best = int(np.argmax(similarity))
+        if similarity[best] < self.similarity_threshold:
+            return None
+        return self.store.get(entries[best][1])
+
+    def put(
+        self,
+        model: str,
+        context: Optional[str],
+        history: List[dict],
+        message: str,
+        response: Response,
+    ) -> None:
+        """
+        Store a response, and the message embedding for the semantic tier.
+
+        Args:
+            model: Name of the model
+            context: Context sent with the message
+            history: Conversation history sent with the message
+            message: The user's message
+            response: Response to cache
+        """
+        scope = request_scope(model, context, history)
+        key = request_key(model, context, history, message)
+        self.store.set(key, response)
+
+        if self.embedding_function is not None:
+            vector = np.asarray(
+                self.embedding_function([normalize(message)])[0], dtype=np.float32
+            )
+            entries = self.store.get(f"semantic:{scope}") or []
+            entries = [e for e in entries if e[1] != key] + [(vector, key)]
+            self.store.set(f"semantic:{scope}", entries[-self.max_semantic_entries :])
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Return the hit and miss counters and the hit ratio"""
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / total if total else None,
+        }
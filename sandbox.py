@@ -0,0 +1,232 @@
+import atexit
+import base64
+import io
+import json
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from functools import cache
+from typing import Any, Dict, List, Optional
+
+from config import sandbox_config
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+# environment variables passed on to the workers; API keys set in the
+# environment stay behind (files such as .env remain readable)
+PASSED_ENVIRONMENT = ["PATH", "LANG", "LC_ALL", "TMPDIR", "SYSTEMROOT", "VIRTUAL_ENV"]
+
+
+class SandboxError(Exception):
+    """Raised when generated code fails, runs out of time or memory, or its worker dies"""
+
+
+def decode(payload: Dict[str, Any]) -> Any:
+    """Turn a result sent by a worker back into a Python object"""
+    kind, data = payload["type"], payload["data"]
+    if kind in ("dataframe", "series"):
+        import pandas as pd
+
+        typ = "frame" if kind == "dataframe" else "series"
+        return pd.read_json(io.StringIO(data), orient=payload["orient"], typ=typ)
+    if kind in ("png", "bytes"):
+        return base64.b64decode(data)
+    # json, or the repr of a result that has no serialized form
+    return data
+
+
+class _Worker:
+    def __init__(self, limits: Dict[str, Any]):
+        self.workdir = tempfile.mkdtemp(prefix="sandbox_")
+        env = {k: os.environ[k] for k in PASSED_ENVIRONMENT if k in os.environ}
+        env.update(
+            HOME=self.workdir,
+            MPLBACKEND="Agg",
+            MPLCONFIGDIR=self.workdir,
+            # BLAS thread pools reserve address space counted by the memory limit
+            OPENBLAS_NUM_THREADS="1",
+            OMP_NUM_THREADS="1",
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER, json.dumps(limits)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.workdir,
+            env=env,
+            text=True,
+            encoding="utf-8",
+        )
+        self.ready = False
+        self.tasks = 0
+        self._replies: "queue.Queue[Optional[str]]" = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            self._replies.put(line)
+        # end of output: the worker exited
+        self._replies.put(None)
+
+    def receive(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Return the next reply, None if the worker died; raises queue.Empty on timeout"""
+        line = self._replies.get(timeout=timeout)
+        return json.loads(line) if line is not None else None
+
+    def send(self, request: Dict[str, Any]) -> None:
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+
+    def exit_reason(self) -> str:
+        code = self.process.wait()
+        if code == -getattr(signal, "SIGXCPU", 0):
+            return "exceeded its CPU time limit"
+        if code == -getattr(signal, "SIGKILL", 0):
+            return "was killed, probably for running out of memory"
+        return f"exited with code {code}"
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class SandboxPool:
+    """
+    Pool of worker processes that run generated Python code.
+
+    The workers are started right away with pandas and matplotlib imported,
+    so an execution doesn't pay for the imports. Each starts in its own
+    scratch directory with a stripped environment, so API keys passed as
+    environment variables are not visible, and runs under CPU time,
+    address space and file size limits. A worker past the wall clock
+    limit, or one that died, is killed and replaced.
+
+    This protects the server from runaway code, not from hostile code: the
+    workers run as the server's user with its view of the filesystem and
+    network, so they can read files such as .env and open connections.
+    Run the application in a container or as a dedicated user when the
+    generated code can't be trusted.
+
+    Attributes:
+        workers: Number of worker processes
+        cpu_seconds: CPU time of one execution
+        wall_seconds: Wall clock time of one execution
+        memory_bytes: Address space a worker may use beyond the preloaded modules
+        file_bytes: Size of the largest file the code may write
+        preload: Modules imported by every worker at start
+        max_tasks: Executions after which a worker is replaced
+        startup_seconds: Time a worker may take to start
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        cpu_seconds: int = 10,
+        wall_seconds: float = 30,
+        memory_bytes: int = 1024**3,
+        file_bytes: int = 64 * 1024**2,
+        preload: List[str] = ["pandas", "matplotlib.pyplot"],
+        max_tasks: int = 100,
+        startup_seconds: float = 60,
+    ):
+        self.wall_seconds = wall_seconds
+        self.max_tasks = max_tasks
+        self.startup_seconds = startup_seconds
+        self.limits = {
+            "cpu_seconds": cpu_seconds,
+            "memory_bytes": memory_bytes,
+            "file_bytes": file_bytes,
+            "preload": preload,
+        }
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._workers: List[_Worker] = []
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self.limits)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        worker.kill()
+        with self._lock:
+            self._workers.remove(worker)
+        return self._spawn()
+
+    def _wait_ready(self, worker: _Worker) -> None:
+        try:
+            message = worker.receive(self.startup_seconds)
+        except queue.Empty:
+            raise SandboxError(f"Sandbox worker did not start in {self.startup_seconds}s")
+        if message is None:
+            raise SandboxError(f"Sandbox worker {worker.exit_reason()} while starting")
+        worker.ready = True
+
+    def run(self, code: str, timeout: Optional[float] = None) -> Any:
+        """
+        Run code in a worker and return the value it assigned to `result`.
+
+        DataFrames and Series come back as pandas objects, figures as PNG
+        bytes, JSON types as themselves and anything else as its repr.
+
+        Args:
+            code: Python code that sets the variable result
+            timeout: Wall clock limit in seconds, defaults to wall_seconds
+
+        Returns:
+            The result of the code
+
+        Raises:
+            SandboxError: The code raised, hit a limit, or the worker died
+        """
+        timeout = timeout or self.wall_seconds
+        worker = self._idle.get()
+        healthy = False
+        try:
+            if not worker.ready:
+                self._wait_ready(worker)
+            worker.send({"code": code})
+            try:
+                reply = worker.receive(timeout)
+            except queue.Empty:
+                raise SandboxError(f"Generated code timed out after {timeout}s")
+            if reply is None:
+                raise SandboxError(f"Sandbox worker {worker.exit_reason()}")
+
+            healthy = True
+            worker.tasks += 1
+            if not reply["ok"]:
+                details = reply.get("traceback", "")
+                raise SandboxError(f"Generated code failed: {reply['error']}\n{details}")
+            return decode(reply["result"])
+        except (BrokenPipeError, OSError) as e:
+            raise SandboxError(f"Sandbox worker is gone: {e}") from e
+        finally:
+            if not healthy or worker.tasks >= self.max_tasks:
+                worker = self._replace(worker)
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.kill()
+
+
+@cache
+def get_sandbox() -> SandboxPool:
+    """Return the sandbox pool shared by all executions of generated code"""
+    pool = SandboxPool(**sandbox_config)
+    atexit.register(pool.close)
+    return pool
@@ -0,0 +1,169 @@
+"""
+Worker process of sandbox.py, runs generated code one request at a time.
+
+Reads JSON requests {"code": ...} from stdin and writes one JSON reply
+per line to stdout. The code must set the variable `result`; it is sent
+back as JSON, a pandas DataFrame or Series in pandas' JSON table format,
+or a matplotlib figure as PNG. Only the standard library is imported up
+front, the modules to preload are passed by the parent.
+"""
+
+import base64
+import importlib
+import io
+import json
+import os
+import shutil
+import sys
+import traceback
+from typing import Any, Dict
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, only the wall clock limit of the parent applies
+    resource = None
+
+
+def preload(modules) -> None:
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"Sandbox worker could not preload {name}: {e}", file=sys.stderr)
+
+
+def address_space() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def set_limits(memory_bytes: int, file_bytes: int) -> None:
+    """Cap the address space and written file size for the life of the worker"""
+    if resource is None:
+        return
+    # hard limits too, so the generated code can't raise them again
+    limits = [(resource.RLIMIT_FSIZE, file_bytes)]
+    if memory_bytes:
+        limits.append((resource.RLIMIT_AS, address_space() + memory_bytes))
+    for limit, value in limits:
+        try:
+            resource.setrlimit(limit, (value, value))
+        except (ValueError, OSError) as e:
+            # e.g. RLIMIT_AS on macOS
+            print(f"Sandbox worker could not set limit {limit}: {e}", file=sys.stderr)
+
+
+def set_cpu_limit(seconds: int) -> None:
+    """Allow the next execution seconds of CPU time, it is killed by SIGXCPU after"""
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    # only the soft limit, it is moved forward for every execution; code that
+    # raises it is still stopped by the wall clock limit of the parent
+    soft = resource.RLIM_INFINITY if not seconds else used + seconds
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def encode(value: Any) -> Dict[str, Any]:
+    pandas = sys.modules.get("pandas")
+    figure = sys.modules.get("matplotlib.figure")
+    pyplot = sys.modules.get("matplotlib.pyplot")
+
+    if pandas is not None and isinstance(value, (pandas.DataFrame, pandas.Series)):
+        kind = "dataframe" if isinstance(value, pandas.DataFrame) else "series"
+        try:
+            return {"type": kind, "orient": "table", "data": value.to_json(orient="table")}
+        except Exception:
+            # e.g. MultiIndex columns, which the table format doesn't support
+            return {"type": kind, "orient": "split", "data": value.to_json(orient="split")}
+
+    if pyplot is not None and value is pyplot:
+        value = pyplot.gcf()
+    if figure is not None and hasattr(value, "figure") and not isinstance(value, figure.Figure):
+        # Axes and artists belong to a figure
+        value = value.figure
+    if figure is not None and isinstance(value, figure.Figure):
+        buffer = io.BytesIO()
+        value.savefig(buffer, format="png")
+        return {"type": "png", "data": base64.b64encode(buffer.getvalue()).decode("ascii")}
+
+    if isinstance(value, bytes):
+        return {"type": "bytes", "data": base64.b64encode(value).decode("ascii")}
+    try:
+        return {"type": "json", "data": json.loads(json.dumps(value))}
+    except (TypeError, ValueError):
+        return {"type": "repr", "data": repr(value)[:10000]}
+
+
+def execute(code: str) -> Dict[str, Any]:
+    namespace = {"__name__": "__sandbox__"}
+    try:
+        exec(compile(code, "<generated>", "exec"), namespace)
+        if "result" not in namespace:
+            raise NameError("the code did not set the variable result")
+        return {"ok": True, "result": encode(namespace["result"])}
+    except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        return {
+            "ok": False,
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc(limit=-5),
+        }
+    finally:
+        pyplot = sys.modules.get("matplotlib.pyplot")
+        if pyplot is not None:
+            pyplot.close("all")
+
+
+def clean_workdir() -> None:
+    for name in os.listdir("."):
+        path = os.path.join(".", name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def main():
+    limits = json.loads(sys.argv[1])
+
+    # the protocol keeps the original pipes, prints of the code go to stderr
+    requests = os.fdopen(os.dup(0), "r", encoding="utf-8")
+    replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+    sys.stdin = open(os.devnull)
+    sys.stdout = sys.stderr
+
+    def reply(message: Dict[str, Any]):
+        replies.write(json.dumps(message) + "\n")
+        replies.flush()
+
+    preload(limits["preload"])
+    set_limits(limits["memory_bytes"], limits["file_bytes"])
+    reply({"ready": True, "pid": os.getpid()})
+
+    for line in requests:
+        request = json.loads(line)
+        set_cpu_limit(limits["cpu_seconds"])
+        response = execute(request["code"])
+        set_cpu_limit(0)
+        clean_workdir()
+        try:
+            reply(response)
+        except (TypeError, ValueError) as e:
+            reply({"ok": False, "error": f"Result could not be sent: {e}"})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+
+class _Call:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        # the leader's caller went away (closed generator, cancelled task)
+        # before the call finished
+        self.abandoned = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one computation.
+
+    The first caller of a key runs the function, callers arriving while it
+    runs wait for it and get the same result or exception. Once the call
+    finishes the key is released, so later callers compute again (caching
+    the result is left to the caller). When the leader's caller goes away
+    before the call finishes, a waiting follower takes over and runs the
+    call again.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _join(self, key: str):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _publish(self, call: _Call, item: Any) -> None:
+        with self._lock:
+            call.items.append(item)
+            self._changed.notify_all()
+
+    def _finish(
+        self, key: str, call: _Call, error: Optional[BaseException], abandoned: bool
+    ) -> None:
+        with self._lock:
+            call.done = True
+            call.error = error
+            call.abandoned = abandoned
+            del self._calls[key]
+            self._changed.notify_all()
+
+    def do(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Call func, or wait for the call already in flight for key.
+
+        Args:
+            key: Key identifying identical calls
+            func: Function to call
+
+        Returns:
+            The result of the single call, or the last item of the
+            iteration in flight for key if a stream is running under it
+        """
+        result = None
+        for result in self.stream(key, lambda: iter([func(*args, **kwargs)])):
+            pass
+        return result
+
+    def stream(self, key: str, func: Callable[..., Iterator[Any]], *args, **kwargs) -> Iterator[Any]:
+        """
+        Iterate func, or follow the iteration already in flight for key.
+
+        Followers get every item the leader produced, including the ones
+        produced before they joined. If the leader is abandoned, the
+        followers join again and the first one leads a new iteration, so
+        they see the items from the start once more.
+
+        Args:
+            key: Key identifying identical calls
+            func: Function returning an iterator
+
+        Yields:
+            The items of the single iteration
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                yield from self._lead(key, call, func, *args, **kwargs)
+                return
+            yield from self._follow(call)
+            if not call.abandoned:
+                return
+
+    def _lead(self, key: str, call: _Call, func, *args, **kwargs) -> Iterator[Any]:
+        error, abandoned = None, False
+        try:
+            for item in func(*args, **kwargs):
+                self._publish(call, item)
+                yield item
+        except Exception as e:
+            error = e
+            raise
+        except BaseException:
+            # followers must not wait forever for an abandoned leader, nor
+            # fail because of it
+            abandoned = True
+            raise
+        finally:
+            self._finish(key, call, error, abandoned)
+
+    def _follow(self, call: _Call) -> Iterator[Any]:
+        i = 0
+        while True:
+            with self._lock:
+                while i == len(call.items) and not call.done:
+                    self._changed.wait()
+                items = call.items[i:]
+                done, error = call.done, call.error
+            for item in items:
+                yield item
+            i += len(items)
+            if done and i == len(call.items):
+                if error is not None:
+                    raise error
+                return
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio variant of SingleFlight for callers on one event loop.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+
+    @staticmethod
+    def _notify(call: _Call) -> None:
+        # waiters hold the current event, a new one is set up for the next change
+        event, call.changed = call.changed, asyncio.Event()
+        event.set()
+
+    async def do(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Await func, or wait for the call already in flight for key.
+
+        Args:
+            key: Key identifying identical calls
+            func: Coroutine function to await
+
+        Returns:
+            The result of the single call, or the last item of the
+            iteration in flight for key if a stream is running under it
+        """
+
+        async def once():
+            yield await func(*args, **kwargs)
+
+        result = None
+        async for result in self.stream(key, once):
+            pass
+        return result
+
+    async def stream(
+        self, key: str, func: Callable[..., AsyncIterator[Any]], *args, **kwargs
+    ) -> AsyncIterator[Any]:
+        """
+        Iterate func, or follow the iteration already in flight for key.
+
+        As in SingleFlight.stream, a follower takes over when the leader's
+        task is cancelled.
+
+        Args:
+            key: Key identifying identical calls
+            func: Function returning an async iterator
+
+        Yields:
+            The items of the single iteration
+        """
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                call.changed = asyncio.Event()
+                lead = self._lead(key, call, func, *args, **kwargs)
+                try:
+                    async for item in lead:
+                        yield item
+                finally:
+                    # a closed stream closes the leading iteration right away,
+                    # not when it is garbage collected
+                    await lead.aclose()
+                return
+            async for item in self._follow(call):
+                yield item
+            if not call.abandoned:
+                return
+
+    async def _lead(self, key: str, call: _Call, func, *args, **kwargs) -> AsyncIterator[Any]:
+        try:
+            async for item in func(*args, **kwargs):
+                call.items.append(item)
+                self._notify(call)
+                yield item
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            call.done = True
+            del self._calls[key]
+            self._notify(call)
+
+    async def _follow(self, call: _Call) -> AsyncIterator[Any]:
+        i = 0
+        while True:
+            if i == len(call.items) and not call.done:
+                await call.changed.wait()
+                continue
+            items = call.items[i:]
+            for item in items:
+                yield item
+            i += len(items)
+            if call.done and i == len(call.items):
+                if call.error is not None:
+                    raise call.error
+                return
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Measure the cold start of the application.
+
+Every measurement runs in a fresh interpreter, so nothing is shared
+through sys.modules. Reports the import time of the main modules, the
+time to build the UI, and which heavy dependencies were loaded by then.
+
+Usage:
+    python startup_benchmark.py --runs 5 --output startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import os
+import sys
+from typing import Dict, List
+
+# the children import the application modules and read ./cache and .env from here
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# modules that should only be imported on first use
+HEAVY_MODULES = ["openai", "google.genai", "chromadb", "onnxruntime", "pandas", "matplotlib"]
+
+TARGETS = {
+    "config": "import config",
+    "llm": "import llm",
+    "request": "import request",
+    "embedding": "import embedding",
+    "chat": "import chat",
+    "ui": "import ui",
+    "create_ui": "import chat, ui; ui.create_ui(chat.chat_wrapper_async, chat.ingest_wrapper)",
+}
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure(statement: str) -> Dict:
+    script = SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(targets: List[str], runs: int) -> Dict[str, Dict]:
+    """
+    Time each target in fresh interpreters.
+
+    Args:
+        targets: Names of TARGETS to measure
+        runs: Number of interpreters per target
+
+    Returns:
+        Median and minimum seconds and the heavy modules loaded, per target
+    """
+    report = {}
+    for name in targets:
+        try:
+            samples = [measure(TARGETS[name]) for _ in range(runs)]
+        except subprocess.CalledProcessError as e:
+            print(f"{name}: failed\n{e.stderr}")
+            continue
+        seconds = [s["seconds"] for s in samples]
+        report[name] = {
+            "median": statistics.median(seconds),
+            "min": min(seconds),
+            "heavy": samples[-1]["heavy"],
+        }
+        print(
+            f"{name:10s} median {report[name]['median']:.3f}s  min {report[name]['min']:.3f}s"
+            f"  heavy: {', '.join(report[name]['heavy']) or '-'}"
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="interpreters per target")
+    parser.add_argument(
+        "--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS)
+    )
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run(args.targets, args.runs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from config import telemetry_config
+
+# span attributes summed into counters, e.g. chat_bytes_total
+COUNTED_ATTRIBUTES = [
+    "bytes",
+    "chunks",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "context_tokens",
+]
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Span:
+    """
+    A timed stage of a request with its attributes.
+
+    Attributes:
+        name: Name of the stage, e.g. "process_file"
+        attributes: Model, byte and token counts, cache result, ...
+        start: Wall clock time the span started
+        duration: Seconds the span took, set when it ends
+        error: Type of the exception that ended the span, if any
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if isinstance(error, Exception):
+            self.error = type(error).__name__
+        elif error is not None:
+            # closed generator or cancelled task, e.g. the losing hedged request
+            self.attributes["cancelled"] = True
+        self.tracer.finish(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            **self.attributes,
+        }
+
+
+class Metrics:
+    """
+    Prometheus-style metrics of the finished spans.
+
+    Span durations go into a histogram per span name and model, and into a
+    window of recent samples from which p50, p95 and p99 are reported.
+    Counted attributes, cache results and errors go into counters.
+
+    Attributes:
+        buckets: Upper bounds of the histogram buckets, in seconds
+        window: Number of recent durations kept for the quantiles
+    """
+
+    def __init__(self, buckets: List[float], window: int = 1000):
+        self.buckets = sorted(buckets)
+        self.window = window
+        self._histograms: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = defaultdict(float)
+        self._samples: Dict[Labels, Deque[float]] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, span: Span) -> None:
+        labels = (("span", span.name), ("model", str(span.attributes.get("model", ""))))
+        with self._lock:
+            counts = self._histograms.setdefault(labels, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, span.duration)] += 1
+            self._sums[labels] += span.duration
+            self._samples.setdefault(labels, deque(maxlen=self.window)).append(span.duration)
+
+            for name in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(name)
+                if isinstance(value, (int, float)):
+                    self._counters[(f"chat_{name}_total", labels)] += value
+            if "cache" in span.attributes:
+                result = span.attributes["cache"] or "miss"
+                self._counters[("chat_cache_total", labels + (("result", str(result)),))] += 1
+            if span.error:
+                self._counters[("chat_errors_total", labels + (("error", span.error),))] += 1
+
+    @staticmethod
+    def _format_labels(labels: Labels, **extra: str) -> str:
+        pairs = list(labels) + list(extra.items())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP chat_span_seconds Duration of the stages of a request",
+            "# TYPE chat_span_seconds histogram",
+        ]
+        with self._lock:
+            for labels, counts in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    total += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = self._format_labels(labels, le=le)
+                    lines.append(f"chat_span_seconds_bucket{bucket_labels} {total}")
+                formatted = self._format_labels(labels)
+                lines.append(f"chat_span_seconds_sum{formatted} {self._sums[labels]}")
+                lines.append(f"chat_span_seconds_count{formatted} {total}")
+
+            lines += [
+                "# HELP chat_span_seconds_recent Quantiles of the recent durations of a stage",
+                "# TYPE chat_span_seconds_recent summary",
+            ]
+            for labels, samples in sorted(self._samples.items()):
+                ordered = sorted(samples)
+                for q in QUANTILES:
+                    value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+                    quantile_labels = self._format_labels(labels, quantile=str(q))
+                    lines.append(f"chat_span_seconds_recent{quantile_labels} {value}")
+
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """
+    Creates spans, feeds finished spans to the metrics and appends them to
+    an optional JSONL trace log.
+
+    Attributes:
+        metrics: Metrics of the finished spans
+        trace_log: Path of the JSONL trace log, None disables it
+    """
+
+    def __init__(self, metrics: Metrics, trace_log: Optional[str] = None):
+        self.metrics = metrics
+        self.trace_log = trace_log
+        self._log_lock = threading.Lock()
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """Start a span that is ended by calling its end method, e.g. across a stream"""
+        return Span(self, name, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Time the enclosed block as a span; exceptions are recorded and re-raised"""
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(e)
+            raise
+        span.end()
+
+    def finish(self, span: Span) -> None:
+        self.metrics.observe(span)
+        if self.trace_log:
+            line = json.dumps(span.to_dict(), default=str)
+            with self._log_lock, open(self.trace_log, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def start_metrics_server(port: int, metrics: Metrics) -> ThreadingHTTPServer:
+    """
+    Serve the metrics on http://0.0.0.0:port/metrics from a daemon thread.
+
+    Args:
+        port: Port to listen on
+        metrics: Metrics to serve
+
+    Returns:
+        The running server
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are too frequent for the console
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+metrics = Metrics(telemetry_config["buckets"], telemetry_config["quantile_window"])
+tracer = Tracer(metrics, telemetry_config["trace_log"])
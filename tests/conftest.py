@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config picks its default model among the models with a key, so it needs one
+os.environ.setdefault("GPT4O_KEY", "test")
@@ -0,0 +1,30 @@
+import sqlite3
+import threading
+from collections import namedtuple
+
+from bm25 import BM25Index
+
+Chunk = namedtuple("Chunk", "id text")
+
+
+def test_concurrent_adds_index_each_chunk_once(tmp_path):
+    path = str(tmp_path / "bm25.sqlite")
+    index = BM25Index(path)
+    chunks = [Chunk(f"c{i}", f"term{i} shared words") for i in range(500)]
+    barrier = threading.Barrier(4)
+    added = []
+
+    def add():
+        barrier.wait()
+        added.append(index.add(chunks, "digest"))
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(added) == [0, 0, 0, 500]
+    con = sqlite3.connect(path)
+    assert con.execute("SELECT COUNT(*) FROM postings WHERE term = 'shared'").fetchone() == (500,)
+    assert index.search("term7", 1, ["digest"])[0][0] == "c7"
@@ -0,0 +1,45 @@
+import random
+
+import chunker
+from chunker import CHUNK_MODEL, chunk_spans
+from tokens import count_tokens
+
+
+def words(n, seed=0):
+    rng = random.Random(seed)
+    return " ".join(
+        "".join(rng.choice("abcdefghij0123456789") for _ in range(rng.randint(1, 12)))
+        for _ in range(n)
+    )
+
+
+def test_long_sentence_is_cut_at_whitespace_within_the_limit():
+    # e.g. a table page without punctuation
+    text = words(5000)
+    spans = chunk_spans(text, max_tokens=64, overlap_tokens=0)
+
+    assert all(count_tokens(text[start:end], CHUNK_MODEL) <= 64 for start, end in spans)
+    assert " ".join(text[start:end] for start, end in spans) == text
+    # pieces are filled rather than cut early
+    assert len(spans) <= count_tokens(text, CHUNK_MODEL) // 48
+
+
+def test_long_sentence_is_tokenized_about_once(monkeypatch):
+    text = words(5000, seed=1)
+    counted = []
+
+    def count(text, model):
+        counted.append(len(text))
+        return count_tokens(text, model)
+
+    monkeypatch.setattr(chunker, "count_tokens", count)
+    chunk_spans(text, max_tokens=64, overlap_tokens=0)
+
+    assert sum(counted) < 4 * len(text)
+
+
+def test_word_longer_than_the_limit_is_kept_whole():
+    text = "short " + "x" * 2000 + " tail"
+    spans = chunk_spans(text, max_tokens=64, overlap_tokens=0)
+
+    assert [text[start:end] for start, end in spans] == ["short", "x" * 2000, "tail"]
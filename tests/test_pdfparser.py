@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("pypdf")
+
+from pdfparser import Document, extract_text, new_text
+
+
+def chunk(document, page, text, start):
+    return Document(document, page, text, f"{page}:{start}", start, start + len(text))
+
+
+def test_overlap_is_dropped_within_a_page():
+    page = "First sentence. Second sentence. Third sentence."
+    first = chunk("a.pdf", 1, page[:32], 0)
+    second = chunk("a.pdf", 1, page[16:], 16)
+
+    assert new_text(first, second) == page[32:]
+    assert extract_text([first, second]) == page
+
+
+def test_next_page_is_not_overlap():
+    # a short page followed by one starting with a blank line: the offsets
+    # of the second page fall inside the first, but start over on the page
+    cover = chunk("a.pdf", 1, "x" * 480, 0)
+    body = chunk("a.pdf", 2, "Chapter one begins here.", 2)
+
+    assert new_text(cover, body) is None
+    assert extract_text([cover, body]) == cover.text + "\n" + body.text
+
+
+def test_txt_overlap_spans_lines():
+    text = "One.\nTwo.\nThree."
+    first = chunk("a.txt", 1, text[:10], 0)
+    second = chunk("a.txt", 2, text[5:], 5)
+
+    assert new_text(first, second) == text[10:]
+    assert extract_text([first, second]) == text
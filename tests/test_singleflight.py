@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def slow_items(items, started=None, delay=0.05):
+    if started is not None:
+        started.set()
+    for item in items:
+        time.sleep(delay)
+        yield item
+
+
+def test_follower_takes_over_closed_leader():
+    flight = SingleFlight()
+    started = threading.Event()
+    result = {}
+
+    leader = flight.stream("key", slow_items, ["a", "b", "c"], started)
+    assert next(leader) == "a"
+
+    def follow():
+        result["items"] = list(flight.stream("key", slow_items, ["x", "y"]))
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    time.sleep(0.1)
+    # e.g. the leader's client disconnected
+    leader.close()
+    follower.join(timeout=5)
+
+    # items of the abandoned call, then the call the follower ran itself
+    assert result["items"][-2:] == ["x", "y"]
+    assert result["items"][0] == "a"
+
+
+def test_follower_gets_upstream_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("upstream")
+        yield
+
+    def follow():
+        started.wait()
+        try:
+            list(flight.stream("key", slow_items, ["x"]))
+        except ValueError as e:
+            errors.append(e)
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    with pytest.raises(ValueError):
+        list(flight.stream("key", failing))
+    follower.join(timeout=5)
+    assert [str(e) for e in errors] == ["upstream"]
+
+
+def test_async_follower_takes_over_cancelled_leader():
+    flight = AsyncSingleFlight()
+
+    async def items(values):
+        for value in values:
+            await asyncio.sleep(0.05)
+            yield value
+
+    async def collect(values):
+        return [item async for item in flight.stream("key", items, values)]
+
+    async def main():
+        leader = asyncio.create_task(collect(["a", "b", "c"]))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(collect(["x", "y"]))
+        await asyncio.sleep(0.07)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.wait_for(follower, 5)
+
+    result = asyncio.run(main())
+    assert result[0] == "a"
+    assert result[-2:] == ["x", "y"]
+
+
+def test_do_joining_a_stream_gets_the_last_item():
+    flight = SingleFlight()
+    started = threading.Event()
+    result = {}
+
+    def follow():
+        started.wait()
+        result["value"] = flight.do("key", lambda: "unused")
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    # partial answers, the last one is complete
+    items = list(flight.stream("key", slow_items, ["par", "partial", "partial answer"], started))
+    follower.join(timeout=5)
+
+    assert items[-1] == "partial answer"
+    assert result["value"] == "partial answer"
+
+
+def test_async_do_joining_a_stream_gets_the_last_item():
+    flight = AsyncSingleFlight()
+
+    async def items(values):
+        for value in values:
+            await asyncio.sleep(0.05)
+            yield value
+
+    async def collect(values):
+        return [item async for item in flight.stream("key", items, values)]
+
+    async def unused():
+        return "unused"
+
+    async def main():
+        stream = asyncio.create_task(collect(["par", "partial answer"]))
+        await asyncio.sleep(0.01)
+        value = await flight.do("key", unused)
+        return value, await stream
+
+    value, streamed = asyncio.run(main())
+    assert streamed[-1] == "partial answer"
+    assert value == "partial answer"
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import cache
+from typing import List, Optional, Tuple
+
+from config import chars_per_token
+
+try:
+    import tiktoken
+except ImportError:  # fall back to the character estimate
+    tiktoken = None
+
+
+# tiktoken encodings of the chat models; Gemini has no local tokenizer, so
+# its counts are estimated with the closest OpenAI encoding
+model_encodings = {
+    "gpt-4o": "o200k_base",
+    "o1-preview": "o200k_base",
+    "gemini": "o200k_base",
+    "text-embedding-3-large": "cl100k_base",
+}
+
+
+# counts are memoized under a hash of the text, so the cache holds no text and
+# an entry is small whatever the length; hashing is far cheaper than tokenizing,
+# which matters for the file context counted again by every turn's request
+TOKEN_CACHE_SIZE = 100_000
+
+_token_counts: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+@cache
+def get_encoding(model: str) -> Optional["tiktoken.Encoding"]:
+    if tiktoken is None:
+        return None
+    name = model_encodings.get(model, "o200k_base")
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # the encoding is downloaded on first use, which fails on offline hosts;
+        # cached, so the download isn't retried on every count
+        print(f"Could not load the {name} encoding, estimating tokens instead: {e}")
+        return None
+
+
+def _count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // chars_per_token)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the tokens of a text with the tokenizer of the model.
+
+    Args:
+        text: Text to count
+        model: Name of the model in model_config
+
+    Returns:
+        Number of tokens
+    """
+    key = (hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), model)
+    with _token_counts_lock:
+        tokens = _token_counts.get(key)
+        if tokens is not None:
+            _token_counts.move_to_end(key)
+            return tokens
+
+    tokens = _count_tokens(text, model)
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        if len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return tokens
+
+
+def token_offsets(text: str, model: str) -> List[int]:
+    """Return the character offset each token of the text starts at"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return list(range(0, len(text), chars_per_token))
+    _, offsets = encoding.decode_with_offsets(encoding.encode(text, disallowed_special=()))
+    return offsets
+
+
+def count_message_tokens(messages: List[dict], model: str) -> int:
+    # each message carries a few tokens of role and separator overhead
+    return sum(count_tokens(m["content"], model) + 4 for m in messages)
+
+
+def trim_history(history: List[dict], budget: int, model: str) -> List[dict]:
+    """
+    Keep the most recent messages of the history that fit a token budget.
+
+    Args:
+        history: Conversation history
+        budget: Maximum number of tokens
+        model: Name of the model in model_config
+
+    Returns:
+        The trimmed history
+    """
+    kept = 0
+    used = 0
+    for message in reversed(history):
+        tokens = count_message_tokens([message], model)
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept += 1
+    return history[len(history) - kept :]
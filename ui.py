@@ -1,8 +1,5 @@
 import gradio as gr
-from config import available_models
-from llm import llm_client
-
-from proposals import proposals
+from config import chat_models, prio_model_name
 
 
 def build_chatbot_column():
@@ -24,18 +21,24 @@ def build_side_column(msg):
             file_count="multiple",
         )
         model_dropdown = gr.Dropdown(
-            choices=available_models,
-            value=llm_client.model,
+            choices=chat_models,
+            value=prio_model_name,
             label="Choose LLM Model",
             interactive=True,
         )
+        retrieval_checkbox = gr.Checkbox(
+            label="Retrieval mode",
+            info="Send only the passages relevant to the question",
+            value=False,
+        )
+        ingest_info = gr.Markdown("")
         token_info = gr.Markdown("**Token Usage:** No messages yet")
         examples = build_examples(msg)
-    return file_input, model_dropdown, token_info, examples
+    return file_input, model_dropdown, retrieval_checkbox, ingest_info, token_info, examples
 
 
 def build_model_version_info():
-    return gr.Markdown(f"**Model:** {llm_client.model}")
+    return gr.Markdown(f"**Model:** {prio_model_name}")
 
 
 def build_last_response():
@@ -54,6 +57,8 @@ def build_message_row():
 
 
 def build_examples(msg):
+    from proposals import proposals
+
     examples = [[item] for item in proposals.values()]  # value inserted into textbox
     example_labels = [item for item in proposals.keys()]  # short button labels
 
@@ -64,7 +69,10 @@ def build_examples(msg):
 
 def update_model_info(model_name: str):
     """
-    Update the model in llm_client and return updated info text.
+    Return the model info text for the model selected in this session.
+
+    The dropdown value is per session and passed to every chat request,
+    which resolves its client from the client registry.
 
     Args:
         model_name: The new model name selected from dropdown
@@ -72,11 +80,10 @@ def update_model_info(model_name: str):
     Returns:
         Updated model info text
     """
-    llm_client.update_model(model_name)
     return f"**Model:** {model_name}"
 
 
-def create_ui(chat_wrapper):
+def create_ui(chat_wrapper, ingest_wrapper=None):
     with gr.Blocks(theme=gr.themes.Base()) as demo:
         model_info = build_model_version_info()
         last_response = build_last_response()
@@ -84,17 +91,35 @@ def create_ui(chat_wrapper):
 
         with gr.Row():
             chatbot = build_chatbot_column()
-            file_input, model_dropdown, token_info, examples = build_side_column(msg)
+            (
+                file_input,
+                model_dropdown,
+                retrieval_checkbox,
+                ingest_info,
+                token_info,
+                examples,
+            ) = build_side_column(msg)
+        uploaded_files = gr.State([])
 
         # Update model_info when dropdown changes
         model_dropdown.change(
             update_model_info, inputs=[model_dropdown], outputs=[model_info]
         )
 
+        # Parse, and in retrieval mode embed, files as soon as they are uploaded
+        if ingest_wrapper is not None:
+            for event in (file_input.change, retrieval_checkbox.change):
+                event(
+                    ingest_wrapper,
+                    [file_input, uploaded_files, retrieval_checkbox],
+                    [ingest_info, uploaded_files],
+                    show_progress="minimal",
+                )
+
         # Submit on enter key press only
         msg.submit(
             chat_wrapper,
-            [msg, chatbot, file_input, model_dropdown],
+            [msg, chatbot, file_input, model_dropdown, retrieval_checkbox],
             [msg, chatbot, last_response, token_info, model_info],
         )
 
@@ -16,23 +16,32 @@ def extract_token_usage(response: Any, client_type: str) -> Dict[str, int]:
         "prompt_tokens": 0,
         "completion_tokens": 0,
         "total_tokens": 0,
+        "cached_tokens": 0,
     }
 
+    if response is None:
+        # streams start with zeros until the usage arrives
+        return token_usage
+
     try:
         if client_type in ["azure_openai", "openai"]:
+            details = getattr(response.usage, "prompt_tokens_details", None)
             token_usage = {
                 "prompt_tokens": response.usage.prompt_tokens,
                 "completion_tokens": response.usage.completion_tokens,
                 "total_tokens": response.usage.total_tokens,
+                # prompt tokens served from the provider's prefix cache
+                "cached_tokens": getattr(details, "cached_tokens", None) or 0,
             }
         elif client_type == "gemini":
             token_usage = {
                 "prompt_tokens": response.usage_metadata.prompt_token_count,
                 "completion_tokens": response.usage_metadata.candidates_token_count,
                 "total_tokens": response.usage_metadata.total_token_count,
+                "cached_tokens": response.usage_metadata.cached_content_token_count or 0,
             }
-    except Exception:
+    except Exception as e:
         # If token extraction fails, return zeros
-        pass
+        print(f"Token usage not found in {client_type} response: {e}")
 
     return token_usage